@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+"""
+Benchmark for the compiler: time compile() on generated programs of
+10k to 1M nodes. Compile time should grow linearly with the size of
+the program, so the time per node should stay roughly constant.
+
+    python bench_compiler.py
+"""
+
+import time
+
+from compiler import *
+
+SIZES = [10**4, 10**5, 10**6]
+
+def count_nodes(e):
+    """
+    Number of nodes (atoms and lists) in the expression e.
+
+    >>> count_nodes([ADD, 1, [MUL, 'x', 2]])
+    7
+    """
+
+    nodes = 0
+    stack = [e]
+    while stack:
+        x = stack.pop()
+        nodes += 1
+        if type(x) == list:
+            stack.extend(x)
+    return nodes
+
+def deep_program(size):
+    """
+    A chain (+ 1 (+ 1 ... (+ 1 x))) inside (lambda (x) ...) applied
+    to 0, nested about size/4 levels deep.
+    """
+
+    e = 'x'
+    for _ in range(size/4):
+        e = [ADD, 1, e]
+    return [[LAMBDA, ['x'], e], 0]
+
+def wide_program(size):
+    """
+    A balanced tree of IF, ADD and SUB over the variables x and y
+    with roughly 'size' nodes, inside (lambda (x y) ...).
+    """
+
+    level = ['x', 'y']*(size/20)
+    depth = 0
+    while len(level) > 1:
+        depth += 1
+        pairs = zip(level[0::2], level[1::2])
+        if depth % 3 == 0:
+            level = [[IF, [ZEROP, a], a, b] for (a, b) in pairs]
+        elif depth % 3 == 1:
+            level = [[ADD, a, b] for (a, b) in pairs]
+        else:
+            level = [[SUB, a, b] for (a, b) in pairs]
+    return [[LAMBDA, ['x', 'y'], level[0]], 1, 2]
+
+def scope_program(size):
+    """
+    A LET binding about size/4 names v0, v1, ... whose body adds them
+    all up, so that every name lookup searches a large scope.
+    """
+
+    names = ['v%d' % i for i in range(size/4)]
+    e = 0
+    for name in names:
+        e = [ADD, name, e]
+    return [LET, names, range(len(names)), e]
+
+def bench(make_program):
+    for size in SIZES:
+        e = make_program(size)
+        nodes = count_nodes(e)
+
+        start = time.time()
+        code = compile(e, [], [STOP])
+        elapsed = time.time() - start
+
+        print '%-8s %9d nodes %8.3f s %6.2f us/node' % (make_program.__name__.split('_')[0],
+                                                        nodes, elapsed, 1e6*elapsed/nodes)
+
+if __name__ == '__main__':
+    bench(deep_program)
+    bench(wide_program)
+    bench(scope_program)
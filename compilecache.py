@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+"""
+On-disk cache for compiled programs. The code that compile() emits for
+an expression is stored in a cache directory, keyed by a hash of the
+expression, the namelist, the trailing code and COMPILER_VERSION, so
+that a program compiled once is loaded rather than compiled again,
+even by another process.
+"""
+
+import errno
+import hashlib
+import marshal
+import os
+import tempfile
+
+from compiler import *
+
+# Cached code is removed, least recently used first, once the cache
+# directory holds more than this many bytes.
+CACHE_MAX_BYTES = 64*1024*1024
+
+# Eviction goes down to this fraction of the limit, so that a full cache is
+# not scanned again on the very next store.
+CACHE_LOW_WATER = 0.75
+
+CACHE_SUFFIX = '.secd'
+
+class CompileCache:
+    """
+    A cache of compiled code in 'directory', which is created if
+    necessary.
+
+    >>> import shutil
+    >>> directory = tempfile.mkdtemp()
+    >>> cache = CompileCache(directory)
+    >>> e = [LETREC, ['f'], [[LAMBDA, ['x', 'm'], [IF, [NULL, 'x'], 'm', ['f', [CDR, 'x'], [ADD, 'm', 1]]]]], ['f', [LIST, 1, 2, 3], 0]]
+    >>> code = cache.compile(e, [], [WRITEI, STOP])
+    >>> code == compile(e, [], [WRITEI, STOP])
+    True
+    >>> cache.hits, cache.misses
+    (0, 1)
+
+    A second cache on the same directory, say in a new process,
+    loads the code instead of compiling it:
+
+    >>> warm = CompileCache(directory)
+    >>> warm.compile(e, [], [WRITEI, STOP]) == code
+    True
+    >>> warm.hits, warm.misses
+    (1, 0)
+    >>> shutil.rmtree(directory)
+    """
+
+    def __init__(self, directory, max_bytes=CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        self.hits   = 0
+        self.misses = 0
+
+        # Bytes in the cache directory as of the last evict(), plus what we
+        # have stored since; None until the directory is first scanned.
+        self.total_bytes = None
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, e, n, c):
+        """
+        Hash of a compilation. repr() of nested lists of ints and
+        strings is canonical, unlike marshal, whose output depends on
+        which strings happen to be interned.
+        """
+
+        return hashlib.sha1(repr((COMPILER_VERSION, e, n, c))).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + CACHE_SUFFIX)
+
+    def compile(self, e, n, c):
+        """
+        Same as compile(e, n, c), using the cached code if there is any.
+        """
+
+        path = self.path(self.key(e, n, c))
+
+        try:
+            f = open(path, 'rb')
+            try:
+                code = marshal.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            code = None
+
+        if code is not None:
+            self.hits += 1
+            try:
+                os.utime(path, None) # most recently used
+            except OSError:
+                pass # evicted by another process since we read it
+            return code
+
+        self.misses += 1
+        code = compile(e, n, c)
+        self.store(path, code)
+        return code
+
+    def store(self, path, code):
+        # Write to a temporary file and rename it, so that another process
+        # never sees a partly written file.
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                marshal.dump(code, f)
+                size = f.tell()
+            finally:
+                f.close()
+            os.rename(tmp, path)
+        except:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+        # Only scan the directory when it may be over its limit.
+        if self.total_bytes is not None:
+            self.total_bytes += size
+        if self.total_bytes is None or self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """
+        If the cache holds more than max_bytes, remove the least
+        recently used entries until it holds at most CACHE_LOW_WATER of
+        max_bytes. This lists the whole directory, so store() only
+        calls it when the running total of bytes goes over max_bytes;
+        entries written by other processes are counted at the next scan.
+
+        >>> import shutil
+        >>> directory = tempfile.mkdtemp()
+        >>> cache = CompileCache(directory, max_bytes=200)
+        >>> for k in range(10): _ = cache.compile([ADD, k, 1], [], [STOP])
+        >>> 0 < len(os.listdir(directory)) < 10
+        True
+        >>> _ = cache.compile([ADD, 9, 1], [], [STOP])
+        >>> cache.hits
+        1
+        >>> cache.total_bytes == sum(os.path.getsize(os.path.join(directory, name))
+        ...                          for name in os.listdir(directory))
+        True
+        >>> shutil.rmtree(directory)
+        """
+
+        entries = []
+        total   = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(CACHE_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError: # removed by another process
+                continue
+            entries.append((st.st_mtime, path, st.st_size))
+            total += st.st_size
+
+        if total > self.max_bytes:
+            target = self.max_bytes*CACHE_LOW_WATER
+        else:
+            target = total
+
+        entries.sort()
+        for (_, path, size) in entries[:-1]: # always keep the newest
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    continue # still there, so still counted
+            total -= size
+
+        self.total_bytes = total
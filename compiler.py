@@ -3,7 +3,7 @@ import logging
 
 global logger
 logger = logging.getLogger('pysecd_compiler')
-logger.setLevel(logging.DEBUG)
+logger.setLevel(logging.WARNING) # logging.DEBUG traces every expression compiled
 ch = logging.StreamHandler()
 ch.setLevel(logging.DEBUG)
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -11,6 +11,10 @@ ch.setFormatter(formatter)
 logger.addHandler(ch)
 
 
+# Change this whenever compile() emits different code for the same input,
+# so that cached code from older versions is not used (see compilecache.py).
+COMPILER_VERSION = 3
+
 # Keywords of our Lisp:
 IF      = 'IF'
 NULL    = 'NULL'
@@ -20,6 +24,27 @@ LET     = 'LET'
 LETREC  = 'LETREC'
 LIST    = 'LIST'
 AND2    = 'AND2'
+DEFINE  = 'DEFINE' # top-level definitions; see session.py
+
+# Opcodes that can be called like functions:
+BUILTINS = [ADD, SUB, MUL, DIV, WRITEI, WRITEC, WRITEB, CAR, CDR, NULL, ZEROP, GT0P, LT0P,
+            LENGTH, APPEND, REVERSE, NTH, EQUAL, EQ, LT, LE, GT, GE, MOD,
+            VEC, VREF, VSET, VLEN, VADD, VSUM] # FIXME Any other builtins?
+
+# Predicates with a fused compare-and-branch opcode; used by compile_if.
+FUSED_BRANCH = {ZEROP: BRZ,
+                GT0P:  BRGT0,
+                LT0P:  BRLT0,
+                NULL:  BRNULL}
+
+# Kinds of work item used by compile_into():
+WORK_EXPR  = 0 # (WORK_EXPR, e[, name]): compile expression e, bound to 'name' by a LET or LETREC
+WORK_EMIT  = 1 # (WORK_EMIT, x[, e]): append x, emitted for the expression e, to the current code block
+WORK_BEGIN = 2 # (WORK_BEGIN[, name]): start a nested code block; with a name (None if
+               # anonymous) the block is the body of a function
+WORK_END   = 3 # (WORK_END,): close the nested code block
+WORK_PUSH  = 4 # (WORK_PUSH, names[, arities]): enter a scope binding 'names'
+WORK_POP   = 5 # (WORK_POP,): leave the innermost scope
 
 # Special keywords for IO actions:
 GET      = 'GET'
@@ -64,9 +89,34 @@ def is_builtin(e):
     """
     A number of SECD opcodes are considered to be built-in
     functions in the language.
+
+    Comparisons consume both operands and leave a single boolean, so
+    a loop test needs no SUB, and nothing is left behind on the stack:
+
+    >>> e = [LETREC, ['count'], [[LAMBDA, ['i', 'n'], [IF, [GE, 'i', 'n'], 'i', ['count', [ADD, 'i', 1], 'n']]]],
+    ...      ['count', 0, [MOD, 17, 10]]]
+    >>> s = SECD()
+    >>> s.halt_stream = None
+    >>> s.load_program(compile(e, [], [STOP]))
+    >>> s.run()
+    7
+    >>> s.get_value(s.registers['S'])
+    [7]
+
+    The list primitives run in a single opcode each:
+
+    >>> code = compile([LET, ['x'], [[LIST, 1, 2, 3]],
+    ...                  [NTH, 1, [APPEND, [REVERSE, 'x'], 'x']]], [], [WRITEI, STOP])
+    >>> s = SECD()
+    >>> s.load_program(code)
+    >>> while s.running: s.execute_opcode()
+    2
+    <BLANKLINE>
+    MACHINE HALTED!
+    <BLANKLINE>
     """
 
-    return e in [ADD, SUB, MUL, DIV, WRITEI, WRITEC, CAR, CDR, NULL, ZEROP, GT0P, LT0P] # FIXME Any other builtins?
+    return e in BUILTINS
 
 def compile_builtin(args, n, c):
     """
@@ -79,12 +129,26 @@ def compile_builtin(args, n, c):
     >>> compile_builtin([1, [MUL, 3, 4]], [], [ADD, STOP])
     ['LDC', 4, 'LDC', 3, 'MUL', 'LDC', 1, 'ADD', 'STOP']
 
+    The first argument ends up on the top of the stack, so vector
+    opcodes take the vector first:
+
+    >>> code = compile([LET, ['v'], [[VEC, [LIST, 1, 2, 3]]],
+    ...                  [VREF, [VADD, 'v', 'v'], 2]], [], [WRITEI, STOP])
+    >>> s = SECD()
+    >>> s.load_program(code)
+    >>> while s.running: s.execute_opcode()
+    6
+    <BLANKLINE>
+    MACHINE HALTED!
+    <BLANKLINE>
+
     """
 
-    if args == []:
-        return c
-    else:
-        return compile_builtin(args[1:], n, compile(args[0], n, c))
+    code = []
+    for arg in reversed(args):
+        compile_into(arg, n, code)
+    code.extend(c)
+    return code
 
 def compile_app(args, n, c):
     """
@@ -95,19 +159,21 @@ def compile_app(args, n, c):
     >>> lambda_expr = [LAMBDA, ['x', 'y'], [SUB, 'x', 'y']]
     >>> code = compile([lambda_expr, 8, 9], [], [WRITEI, STOP])
     >>> print code
-    ['NIL', 'LDC', 9, 'CONS', 'LDC', 8, 'CONS', 'LDF', ['LD', [1, 2], 'LD', [1, 1], 'SUB', 'RTN'], 'AP', 'WRITEI', 'STOP']
+    ['LDC', 9, 'LDC', 8, 'LDF', ['LD', [1, 2], 'LD', [1, 1], 'SUB', 'RTN'], 'AP2', 'WRITEI', 'STOP']
 
     >>> s = SECD()
     >>> s.load_program(code)
-    >>> for _ in range(12): s.execute_opcode()
+    >>> for _ in range(9): s.execute_opcode()
     -1
 
     """
 
-    if args == []:
-        return c
-    else:
-        return compile_app(args[1:], n, compile(args[0], n, [CONS] + c))
+    code = []
+    for arg in reversed(args):
+        compile_into(arg, n, code)
+        code.append(CONS)
+    code.extend(c)
+    return code
 
 def compile_if(test, then_code, else_code, n, c):
     """
@@ -137,15 +203,27 @@ def compile_if(test, then_code, else_code, n, c):
     MACHINE HALTED!
     <BLANKLINE>
 
+    If the test is one of the predicates ZEROP, GT0P, LT0P or NULL
+    we emit the fused branch opcode instead of the predicate followed
+    by SEL:
+
+    >>> code = compile([IF, [ZEROP, 0], [WRITEI, 111], [WRITEI, 222]], [], [STOP])
+    >>> print code
+    ['LDC', 0, 'BRZ', ['LDC', 111, 'WRITEI', 'JOIN'], ['LDC', 222, 'WRITEI', 'JOIN'], 'STOP']
+    >>> s = SECD()
+    >>> s.load_program(code)
+    >>> while s.running: s.execute_opcode()
+    111
+    <BLANKLINE>
+    MACHINE HALTED!
+    <BLANKLINE>
+    >>> s.get_value(s.registers['S'])
+    []
+
     """
 
-    global logger
-    logger.debug('compile_if: test: %s; then_code: %s; else_code: %s, n: %s, c: %s',
-                 str(test), str(then_code), str(else_code), str(n), str(c))
+    return compile([IF, test, then_code, else_code], n, c)
 
-    return compile(test, n, [SEL] + [compile(then_code, n, [JOIN])]
-                                  + [compile(else_code, n, [JOIN])]
-                                  + c)
 def compile_and2(test1, test2, then_code, else_code, n, c):
     """
     FIXME
@@ -196,7 +274,7 @@ def compile_and2(test1, test2, then_code, else_code, n, c):
 
     >>> code = compile([AND2, [ZEROP, 0], [ZEROP, 0], [WRITEI, 111], [WRITEI, 222]], [], [STOP])
     >>> print code
-    ['LDC', 0, 'ZEROP', 'SEL', ['LDC', 0, 'ZEROP', 'SEL', ['LDC', 111, 'WRITEI', 'JOIN'], ['LDC', 222, 'WRITEI', 'JOIN'], 'JOIN'], ['LDC', 222, 'WRITEI', 'JOIN'], 'STOP']
+    ['LDC', 0, 'BRZ', ['LDC', 0, 'BRZ', ['LDC', 111, 'WRITEI', 'JOIN'], ['LDC', 222, 'WRITEI', 'JOIN'], 'JOIN'], ['LDC', 222, 'WRITEI', 'JOIN'], 'STOP']
     >>> s = SECD()
     >>> s.load_program(code)
     >>> while s.running: s.execute_opcode()
@@ -206,18 +284,18 @@ def compile_and2(test1, test2, then_code, else_code, n, c):
     <BLANKLINE>
     """
 
-    global logger
-    logger.debug('compile_and2: test1: %s; test2: %s; then_code: %s; else_code: %s, n: %s, c: %s',
-                 str(test1), str(test2), str(then_code), str(else_code), str(n), str(c))
-
-    return compile([IF, test1, [IF, test2, then_code, else_code], else_code], n, c)
+    return compile([AND2, test1, test2, then_code, else_code], n, c)
 
 def index(e, n):
     """
     Auxilliary function for the SECD compiler. Taken from
-    Figure 7-22 of K1991.
+    Figure 7-22 of K1991. The compiler itself uses Scope, which
+    gives the same answers in constant time.
 
-    FIXME doctest!
+    >>> index('y', [['x', 'y'], ['y']])
+    [1, 2]
+    >>> index('z', [['x', 'y'], ['y']])
+    []
     """
 
     def indx2(e, n, j):
@@ -249,6 +327,95 @@ def index(e, n):
         assert type(rval[1]) == int
         return rval
 
+class Scope:
+    """
+    The compiler's lexical environment. It plays the part of the
+    namelist n of K1991, a list of lists of names, innermost first,
+    but resolves a name to its index [i, j] in constant time instead
+    of by a linear search through n: each scope is a dict from name
+    to position, and for every name we keep the depths of the scopes
+    that bind it.
+
+    >>> scope = Scope([['x', 'y'], ['z', 'x']])
+    >>> scope.index('x'), scope.index('y'), scope.index('z')
+    ([1, 1], [1, 2], [2, 1])
+    >>> scope.index('w')
+    []
+
+    >>> scope.push(['y'])
+    >>> scope.index('x'), scope.index('y')
+    ([2, 1], [1, 1])
+    >>> scope.pop()
+    >>> scope.index('y')
+    [1, 2]
+
+    A scope may also record the arity of the names that are bound to
+    functions with a known number of parameters:
+
+    >>> scope.push(['f', 'y'], [2, None])
+    >>> scope.arity('f'), scope.arity('y'), scope.arity('z')
+    (2, None, None)
+
+    The results agree with index():
+
+    >>> index('x', [['x', 'y'], ['z', 'x']])
+    [1, 1]
+    """
+
+    def __init__(self, n=[]):
+        # frames[d] maps each name bound at depth d (0 is outermost) to
+        # its position j; depths[name] lists the depths binding name.
+        self.frames  = []
+        self.arities = [] # arities[d] maps names bound at depth d to their arity
+        self.depths  = {}
+
+        for names in reversed(n):
+            self.push(names)
+
+    def push(self, names, arities=None):
+        frame = {}
+        known = {}
+        for (j, name) in enumerate(names):
+            if name not in frame: # the first occurrence wins, as in index()
+                frame[name] = j + 1
+                if arities is not None and arities[j] is not None:
+                    known[name] = arities[j]
+
+        depth = len(self.frames)
+        self.frames.append(frame)
+        self.arities.append(known)
+        for name in frame:
+            self.depths.setdefault(name, []).append(depth)
+
+    def pop(self):
+        frame = self.frames.pop()
+        self.arities.pop()
+        for name in frame:
+            self.depths[name].pop()
+
+    def index(self, e):
+        """
+        The [i, j] pair for the name e, or [] if e is not bound.
+        """
+
+        depths = self.depths.get(e)
+        if not depths:
+            return []
+
+        depth = depths[-1]
+        return [len(self.frames) - depth, self.frames[depth][e]]
+
+    def arity(self, e):
+        """
+        The number of parameters of the function bound to the name e,
+        or None if that is not known.
+        """
+
+        depths = self.depths.get(e)
+        if not depths:
+            return None
+        return self.arities[depths[-1]].get(e)
+
 def compile_lambda(body, n, c):
     """
     Compile a lambda expression.
@@ -260,12 +427,14 @@ def compile_lambda(body, n, c):
 
     return [LDF, compile(body, n, [RTN])] + c
 
-def compile(e, n, c):
+def compile(e, n, c, source_map=None):
     """
     Compile an expression 'e', given a namelist 'n', and an
-    accumulating parameter 'c'.
+    accumulating parameter 'c'. The code for 'e' is followed by 'c'.
+    If 'source_map' is a dict it is filled in as by compile_into().
 
-    This function is an almost direct copy of Figure 7-21 of K1991.
+    This function follows Figure 7-21 of K1991; see compile_into()
+    for how the code is generated.
 
     >>> compile(NIL, [], [STOP])
     ['NIL', 'STOP']
@@ -286,15 +455,15 @@ def compile(e, n, c):
     >>> code = compile([LET, ['x', 'y'], [5, 7], [SUB, 'x', 'y']], [], [STOP])
     >>> s = SECD()
     >>> s.load_program(code)
-    >>> for _ in range(12): s.execute_opcode()
+    >>> for _ in range(9): s.execute_opcode()
     <BLANKLINE>
     MACHINE HALTED!
     <BLANKLINE>
 
     >>> s.dump_registers()
-    S: address = 67 value: [-2]
+    S: address = 53 value: [-2]
     E: address = 3 value: []
-    C: address = 45 value: 45
+    C: address = 39 value: 39
     D: address = 4 value: []
 
     >>> c = compile([LIST, 1, 2, 3], [], [STOP])
@@ -311,10 +480,10 @@ def compile(e, n, c):
 
     >>> c = compile([LET, ['x'], [[LIST, 1, 2, 3]], [CAR, 'x']], [], [WRITEI, STOP])
     >>> print c
-    ['NIL', 'NIL', 'LDC', 3, 'CONS', 'LDC', 2, 'CONS', 'LDC', 1, 'CONS', 'CONS', 'LDF', ['LD', [1, 1], 'CAR', 'RTN'], 'AP', 'WRITEI', 'STOP']
+    ['NIL', 'LDC', 3, 'CONS', 'LDC', 2, 'CONS', 'LDC', 1, 'CONS', 'LDF', ['LD', [1, 1], 'CAR', 'RTN'], 'AP1', 'WRITEI', 'STOP']
     >>> s = SECD()
     >>> s.load_program(c)
-    >>> for _ in range(15): s.execute_opcode()
+    >>> for _ in range(13): s.execute_opcode()
     1
 
     Example on p. 164 of LETREC:
@@ -326,7 +495,11 @@ def compile(e, n, c):
 
     >>> code = compile([LETREC, ['f'], [[LAMBDA, ['x', 'm'], [IF, [NULL, 'x'], 'm', ['f', [CDR, 'x'], [ADD, 'm', 1]]]]], ['f', [LIST, 1, 2, 3], 0]], [], [WRITEI, STOP])
     >>> print code
-    ['DUM', 'NIL', 'LDF', ['LD', [1, 1], 'NULL', 'SEL', ['LD', [1, 2], 'JOIN'], ['NIL', 'LDC', 1, 'LD', [1, 2], 'ADD', 'CONS', 'LD', [1, 1], 'CDR', 'CONS', 'LD', [2, 1], 'AP', 'JOIN'], 'RTN'], 'CONS', 'LDF', ['NIL', 'LDC', 0, 'CONS', 'NIL', 'LDC', 3, 'CONS', 'LDC', 2, 'CONS', 'LDC', 1, 'CONS', 'CONS', 'LD', [1, 1], 'AP', 'RTN'], 'RAP', 'WRITEI', 'STOP']
+    ['DUM', 'NIL', 'LDF', ['LD', [1, 1], 'BRNULL', ['LD', [1, 2], 'JOIN'], ['LDC', 1, 'LD', [1, 2], 'ADD', 'LD', [1, 1], 'CDR', 'LD', [2, 1], 'AP2', 'JOIN'], 'RTN'], 'CONS', 'LDF', ['LDC', 0, 'NIL', 'LDC', 3, 'CONS', 'LDC', 2, 'CONS', 'LDC', 1, 'CONS', 'LD', [1, 1], 'AP2', 'RTN'], 'RAP', 'WRITEI', 'STOP']
+
+    Since f is bound to a LAMBDA of two parameters, the calls to it
+    push the two arguments and use AP2 rather than consing a list of
+    them for AP.
 
     >>> s = SECD()
     >>> s.load_program(code)
@@ -357,74 +530,987 @@ def compile(e, n, c):
     ['LDF', ['LD', [1, 2], 'LD', [1, 1], 'ADD', 'RTN'], 'STOP']
 
     >>> compile([[LAMBDA, ['x', 'y'], [ADD, 'x', 'y']], 8, 9], [], [STOP])
-    ['NIL', 'LDC', 9, 'CONS', 'LDC', 8, 'CONS', 'LDF', ['LD', [1, 2], 'LD', [1, 1], 'ADD', 'RTN'], 'AP', 'STOP']
+    ['LDC', 9, 'LDC', 8, 'LDF', ['LD', [1, 2], 'LD', [1, 1], 'ADD', 'RTN'], 'AP2', 'STOP']
+
+    A function whose arity is not known, or that is given the wrong
+    number of arguments, gets its arguments as a list:
+
+    >>> compile([LAMBDA, ['f'], ['f', 8, 9]], [], [STOP])
+    ['LDF', ['NIL', 'LDC', 9, 'CONS', 'LDC', 8, 'CONS', 'LD', [1, 1], 'AP', 'RTN'], 'STOP']
+
+    """
 
+    code = compile_into(e, n, [], source_map)
+    code.extend(c)
+    return code
+
+def app_args(args, names=None):
+    """
+    Work items that build the argument list for an application: the
+    last argument is consed on first. If 'names' is given, names[i]
+    is the name that args[i] is bound to.
+    """
+
+    items = []
+    for i in reversed(range(len(args))):
+        items.append(expression_item(args[i], names and names[i]))
+        items.append((WORK_EMIT, CONS))
+    return items
+
+def expression_item(e, name=None):
+    """
+    Work item to compile 'e', which a LET or LETREC binds to 'name'
+    if that is given.
+    """
+
+    if name is None:
+        return (WORK_EXPR, e)
+    return (WORK_EXPR, e, name)
+
+def lambda_body(body, names, arities=None, name=None):
+    """
+    Work items for LDF followed by the code block of a function body
+    that binds 'names'. 'name' is the name of the function, if it has
+    one.
+    """
+
+    return [(WORK_EMIT, LDF), (WORK_BEGIN, name), (WORK_PUSH, names, arities),
+            (WORK_EXPR, body), (WORK_POP,), (WORK_EMIT, RTN), (WORK_END,)]
+
+def lambda_arity(e):
+    """
+    The number of parameters of e if it is a LAMBDA expression, and
+    None otherwise.
+
+    >>> lambda_arity([LAMBDA, ['x', 'y'], [ADD, 'x', 'y']]), lambda_arity('f')
+    (2, None)
+    """
+
+    if type(e) == list and len(e) == 3 and e[0] == LAMBDA:
+        return len(e[1])
+    return None
+
+def frame_args(args, names=None):
+    """
+    Work items that push the arguments of an application whose callee
+    has a known arity, ready for AP1, AP2 or APN: the last argument is
+    pushed first, so the first one ends up nearest the closure. If
+    'names' is given, names[i] is the name that args[i] is bound to.
+    """
+
+    return [expression_item(args[i], names and names[i]) for i in reversed(range(len(args)))]
+
+def frame_apply(k):
+    """
+    Work items that apply a function to k arguments on the stack.
+
+    >>> frame_apply(1), frame_apply(3)
+    ([(1, 'AP1')], [(1, 'APN'), (1, 3)])
+    """
+
+    if k == 1:
+        return [(WORK_EMIT, AP1)]
+    if k == 2:
+        return [(WORK_EMIT, AP2)]
+    return [(WORK_EMIT, APN), (WORK_EMIT, k)]
+
+def compile_into(e, n, code, source_map=None):
+    """
+    Append the code for the expression 'e', with namelist 'n', to
+    the list 'code', and return 'code'.
+
+    Figure 7-21 of K1991 prepends each instruction to the code that
+    follows it, which copies that code every time, and recurses on
+    every subexpression. Instead we append instructions in execution
+    order, one list per code block (function bodies and the branches
+    of an IF are nested blocks), and keep the work still to be done
+    on an explicit stack. Names are resolved through a Scope. So
+    compilation takes time linear in the size of the program and
+    deeply nested programs do not hit Python's recursion limit.
+
+    >>> compile_into([ADD, 1, 2], [], [LDC, 0])
+    ['LDC', 0, 'LDC', 2, 'LDC', 1, 'ADD']
+
+    >>> e = 0
+    >>> for _ in range(100000): e = [ADD, 1, e]
+    >>> code = compile_into(e, [], [])
+    >>> len(code), code[:5]
+    (300002, ['LDC', 0, 'LDC', 1, 'ADD'])
+
+    If 'source_map' is a dict, each element of the code that is added
+    is mapped to where it came from. The position of an element is
+    the tuple of indices that leads to it from 'code', through the
+    nested code blocks, and it is mapped to (function, e): e is the
+    subexpression that the element was emitted for, and function is
+    the name that a LET or LETREC binds the enclosing LAMBDA to, or
+    None in an anonymous function or outside any function.
+    load_program() turns these positions into memory addresses.
+
+    >>> source_map = {}
+    >>> e = [LETREC, ['f'], [[LAMBDA, ['n'], [IF, [ZEROP, 'n'], 0, ['f', [SUB, 'n', 1]]]]], ['f', 2]]
+    >>> code = compile_into(e, [], [], source_map)
+    >>> code[3]
+    ['LD', [1, 1], 'BRZ', ['LDC', 0, 'JOIN'], ['LDC', 1, 'LD', [1, 1], 'SUB', 'LD', [2, 1], 'AP1', 'JOIN'], 'RTN']
+    >>> source_map[(3, 2)]
+    ('f', ['IF', ['ZEROP', 'n'], 0, ['f', ['SUB', 'n', 1]]])
+    >>> source_map[(3, 4, 4)]
+    ('f', ['SUB', 'n', 1])
+    >>> code[6], source_map[(6, 4)]
+    (['LDC', 2, 'LD', [1, 1], 'AP1', 'RTN'], (None, ['f', 2]))
+
+    The code is only mapped as compiled: optimising it afterwards, say
+    with peephole(), moves instructions around.
     """
 
     global logger
 
-    if is_atom(e):
-        if e == NIL:
-            logger.debug('compile: decided that <%s> is an atom', str(e))
-            return [NIL] + c
-        else:
-            ij = index(e, n)
-            if ij == []:
-                logger.debug('compile: decided that <%s> is a constant' % (str(e),))
-                return [LDC] + [e] + c
+    scope  = Scope(n)
+    blocks = [code]
+    work   = [(WORK_EXPR, e)]
+
+    # For the source map: the position of each open code block, and the
+    # name of the function it belongs to.
+    paths     = [()]
+    functions = [None]
+
+    def mark(start, e):
+        # Map the elements of the current block from 'start' on to e.
+        for i in range(start, len(blocks[-1])):
+            source_map[paths[-1] + (i,)] = (functions[-1], e)
+
+    while work:
+        item = work.pop()
+
+        if item[0] == WORK_EMIT:
+            blocks[-1].append(item[1])
+            if source_map is not None:
+                mark(len(blocks[-1]) - 1, item[2])
+            continue
+        elif item[0] == WORK_BEGIN:
+            if source_map is not None:
+                paths.append(paths[-1] + (len(blocks[-1]),))
+                functions.append(item[1] if len(item) > 1 else functions[-1])
+            blocks.append([])
+            continue
+        elif item[0] == WORK_END:
+            block = blocks.pop()
+            blocks[-1].append(block)
+            if source_map is not None:
+                paths.pop()
+                functions.pop()
+            continue
+        elif item[0] == WORK_PUSH:
+            scope.push(*item[1:])
+            continue
+        elif item[0] == WORK_POP:
+            scope.pop()
+            continue
+
+        e = item[1]
+
+        if is_atom(e):
+            start = len(blocks[-1])
+            if type(e) == int:
+                blocks[-1].extend([LDC, e])
+            elif e == NIL:
+                logger.debug('compile: decided that <%s> is an atom', e)
+                blocks[-1].append(NIL)
             else:
-                logger.debug('compile: decided that <%s> is an identifier, index ij = <%s>' % (str(e), str(ij),))
-                return [LD]  + [ij]  + c
-    else:
+                ij = scope.index(e)
+                if ij == []:
+                    logger.debug('compile: decided that <%s> is a constant', e)
+                    blocks[-1].extend([LDC, e])
+                else:
+                    logger.debug('compile: decided that <%s> is an identifier, index ij = <%s>', e, ij)
+                    blocks[-1].extend([LD, ij])
+            if source_map is not None:
+                mark(start, e)
+            continue
+
         fcn  = e[0]
         args = e[1:]
 
+        # Work items for this expression, in execution order.
         if is_atom(fcn): # builtin, lambda, or special form
             if is_builtin(fcn):
-                logger.debug('compile: fcn = <%s> is a built-in; args = <%s>' % (fcn, args,))
-                return compile_builtin(args, n, [fcn] + c)
+                logger.debug('compile: fcn = <%s> is a built-in', fcn)
+                todo = [(WORK_EXPR, arg) for arg in reversed(args)] + [(WORK_EMIT, fcn)]
             elif fcn == LIST:
                 # My own convenient built-in for making lists. Sample use:
                 # [LIST, 1, 2, 3] => [1, 2, 3].
                 #
                 # FIXME Not sure how this would behave on examples other than
                 # a simple list of ints, variable names, etc.
-                list_body = flatten1L([compile(list_item, n, [CONS]) for list_item in args][::-1])
-                return [NIL] + list_body + c
+                todo = [(WORK_EMIT, NIL)] + app_args(args)
             elif fcn == IOACTION:
                 print 'IOACTION:', 'e:', e
-                return e + c
+                start = len(blocks[-1])
+                blocks[-1].extend(e)
+                if source_map is not None:
+                    mark(start, e)
+                continue
             elif fcn == LAMBDA:
-                logger.debug('compile LAMBDA: fcn is a LAMBDA, args[1] = <%s>; args[0] = <%s>' % (args[1], args[0],))
+                logger.debug('compile LAMBDA: names = <%s>', args[0])
                 assert len(args) == 2 # i.e. args == [name list, body]
-                return compile_lambda(args[1], [args[0]] + n, c)
+                todo = lambda_body(args[1], args[0], name=item[2] if len(item) > 2 else None)
             elif fcn == IF:
                 logger.debug('compile: fcn is an IF')
-                return compile_if(args[0], args[1], args[2], n, c)
-            elif fcn == 'AND2':
+                test, then_code, else_code = args
+
+                # Predicates with a fused branch opcode skip the SEL.
+                if type(test) == list and len(test) == 2 and test[0] in FUSED_BRANCH:
+                    todo = [(WORK_EXPR, test[1]), (WORK_EMIT, FUSED_BRANCH[test[0]])]
+                else:
+                    todo = [(WORK_EXPR, test), (WORK_EMIT, SEL)]
+
+                todo += [(WORK_BEGIN,), (WORK_EXPR, then_code), (WORK_EMIT, JOIN), (WORK_END,),
+                         (WORK_BEGIN,), (WORK_EXPR, else_code), (WORK_EMIT, JOIN), (WORK_END,)]
+            elif fcn == AND2:
                 logger.debug('compile: fcn is an AND2')
-                return compile_and2(args[0], args[1], args[2], args[3], n, c)
+                test1, test2, then_code, else_code = args
+                todo = [(WORK_EXPR, [IF, test1, [IF, test2, then_code, else_code], else_code])]
             elif fcn == LET or fcn == LETREC:
-                newn   = [args[0]] + n
+                names  = args[0]
                 values = args[1]
                 body   = args[2]
 
+                # Names bound to a LAMBDA are called with AP1, AP2 or APN.
+                arities = [lambda_arity(value) for value in values]
+
                 if fcn == LET:
                     logger.debug('compile: fcn is LET')
-                    return [NIL]      + compile_app(values, n,    compile_lambda(body, newn, [AP] + c)) # another typo in Figure 7-21: cons(AP, C) -> cons(AP, c)
-                elif fcn == LETREC:
-                    logger.debug('compile LETREC: fcn is LETREC')
-                    logger.debug('compile LETREC: values: ' + str(values))
-                    logger.debug('compile LETREC: newn:   ' + str(newn))
-                    logger.debug('compile LETREC: body:   ' + str(body))
-
-                    return [DUM, NIL] + compile_app(values, newn, compile_lambda(body, newn, [RAP] + c))
+                    todo = frame_args(values, names) + lambda_body(body, names, arities) + frame_apply(len(values))
+                else:
+                    # The values of a LETREC are compiled in the scope of its names.
+                    logger.debug('compile LETREC: names: <%s>', names)
+                    todo = ([(WORK_EMIT, DUM), (WORK_EMIT, NIL), (WORK_PUSH, names, arities)] + app_args(values, names) + [(WORK_POP,)]
+                            + lambda_body(body, names, arities) + [(WORK_EMIT, RAP)])
+            elif scope.arity(fcn) == len(args):
+                logger.debug('compile: fcn = <%s> is applied to %d arguments', fcn, len(args))
+                todo = frame_args(args) + [(WORK_EMIT, LD), (WORK_EMIT, scope.index(fcn))] + frame_apply(len(args))
             else:
-                logger.debug('compile: fcn = <%s>; args = <%s>' % (fcn, args,))
-                return [NIL] + compile_app(args, n, [LD] + [index(fcn, n)] + [AP] + c)
+                logger.debug('compile: fcn = <%s> is applied', fcn)
+                todo = [(WORK_EMIT, NIL)] + app_args(args) + [(WORK_EMIT, LD), (WORK_EMIT, scope.index(fcn)), (WORK_EMIT, AP)]
 
+        elif lambda_arity(fcn) == len(args): # a LAMBDA applied directly
+            todo = frame_args(args) + [(WORK_EXPR, fcn)] + frame_apply(len(args))
         else: # an application with nested function
-            return [NIL] + compile_app(args, n, compile(fcn, n, [AP] + c))
+            todo = [(WORK_EMIT, NIL)] + app_args(args) + [(WORK_EXPR, fcn), (WORK_EMIT, AP)]
+
+        if source_map is not None:
+            todo = [x + (e,) if x[0] == WORK_EMIT else x for x in todo]
+
+        work.extend(reversed(todo))
+
+    return code
+
+# Builtins that fold to a constant when their arguments are integers.
+FOLD_ARITHMETIC = {ADD: lambda a, b: a + b,
+                   SUB: lambda a, b: a - b,
+                   MUL: lambda a, b: a * b,
+                   DIV: lambda a, b: a / b,
+                   MOD: lambda a, b: a % b,
+                   EQ:  lambda a, b: int(a == b),
+                   LT:  lambda a, b: int(a <  b),
+                   LE:  lambda a, b: int(a <= b),
+                   GT:  lambda a, b: int(a >  b),
+                   GE:  lambda a, b: int(a >= b)}
+
+FOLD_PREDICATE  = {ZEROP: lambda a: a == 0,
+                   GT0P:  lambda a: a > 0,
+                   LT0P:  lambda a: a < 0}
+
+def fold(e):
+    """
+    Constant folding and partial evaluation. Returns an expression
+    equivalent to 'e' in which arithmetic and predicates on integers
+    have been computed, IF and AND2 forms with a constant test have
+    been replaced by the branch taken, and LET-bound constants have
+    been substituted into the body of the LET.
+
+    >>> fold([ADD, 1, [MUL, 2, 3]])
+    7
+    >>> fold([IF, [ZEROP, [SUB, 2, 2]], 'x', 'y'])
+    'x'
+    >>> fold([AND2, 1, [GT0P, 'x'], 'a', 'b'])
+    ['IF', ['GT0P', 'x'], 'a', 'b']
+    >>> fold([IF, [LT, [MOD, 7, 3], 2], 'x', 'y'])
+    'x'
+
+    ZEROP, GT0P, LT0P and NULL leave their operand on the stack, so
+    they are folded only as the test of an IF or AND2:
+
+    >>> fold([ADD, [ZEROP, 0], 5])
+    ['ADD', ['ZEROP', 0], 5]
+
+    Constants bound by a LET are propagated, unless a name is
+    rebound further in:
+
+    >>> fold([LET, ['x', 'y'], [[ADD, 1, 1], 'z'],
+    ...       [ADD, [MUL, 'x', 'y'], [LAMBDA, ['x'], [SUB, 'x', 1]]]])
+    ['LET', ['y'], ['z'], ['ADD', ['MUL', 2, 'y'], ['LAMBDA', ['x'], ['SUB', 'x', 1]]]]
+
+    Division by zero is left for the machine:
+
+    >>> fold([DIV, 1, 0])
+    ['DIV', 1, 0]
+    >>> fold([MOD, 1, 0])
+    ['MOD', 1, 0]
+
+    Like compile() the pass keeps its own stack, so it handles deeply
+    nested programs.
+    """
+
+    env  = {}  # name -> stack of bindings: the constant it stands for, or None
+    done = []  # folded expressions
+    work = [e] # expressions to fold, and functions to run once their parts are in 'done'
+
+    def bind(names, values):
+        for (name, value) in zip(names, values):
+            env.setdefault(name, []).append(value)
+
+    def unbind(names):
+        for name in names:
+            env[name].pop()
+
+    def take(k):
+        # The last k folded expressions.
+        if k == 0:
+            return []
+        parts = done[-k:]
+        del done[-k:]
+        return parts
+
+    def then(f, *exprs):
+        # Fold the expressions, then call f on the results.
+        work.append(lambda: f(*take(len(exprs))))
+        work.extend(reversed(exprs))
+
+    def then_test(f, t):
+        # Fold the test of an IF or AND2, then call f on the result. A
+        # predicate of a constant becomes a constant here: the branch is
+        # then chosen now, and nothing is left on the stack.
+        if is_atom(t) or not (t[0] in FOLD_PREDICATE or t[0] == NULL):
+            then(f, t)
+            return
+        fcn = t[0]
+        def predicate(a):
+            if fcn == NULL:
+                f(1 if a == NIL else [NULL, a])
+            elif type(a) == int:
+                f(int(FOLD_PREDICATE[fcn](a)))
+            else:
+                f([fcn, a])
+        then(predicate, *t[1:])
+
+    def visit(e):
+        if is_atom(e):
+            bound = env.get(e) if type(e) == str else None
+            if bound and bound[-1] is not None:
+                done.append(bound[-1])
+            else:
+                done.append(e)
+            return
+
+        if not is_atom(e[0]): # nested application
+            then(lambda *parts: done.append(list(parts)), *e)
+            return
+
+        fcn, args = e[0], e[1:]
+
+        if fcn in FOLD_ARITHMETIC:
+            def arithmetic(a, b):
+                if type(a) == int and type(b) == int and not (fcn in [DIV, MOD] and b == 0):
+                    done.append(FOLD_ARITHMETIC[fcn](a, b))
+                else:
+                    done.append([fcn, a, b])
+            then(arithmetic, *args)
+        elif fcn in FOLD_PREDICATE or fcn == NULL:
+            # The result goes on top of the operand, which is left on the
+            # stack, so only the test of an IF or AND2 may be folded (see
+            # then_test()).
+            then(lambda a: done.append([fcn, a]), *args)
+        elif fcn == IF:
+            test, then_code, else_code = args
+            def branch(t):
+                if type(t) == int:
+                    work.append(then_code if t else else_code)
+                else:
+                    then(lambda a, b: done.append([IF, t, a, b]), then_code, else_code)
+            then_test(branch, test)
+        elif fcn == AND2:
+            test1, test2, then_code, else_code = args
+            def and2(t1):
+                if type(t1) == int:
+                    work.append([IF, test2, then_code, else_code] if t1 else else_code)
+                    return
+                def and2_rest(t2, a, b):
+                    if type(t2) == int and t2:
+                        done.append([IF, t1, a, b])
+                    else:
+                        done.append([AND2, t1, t2, a, b])
+                then_test(lambda t2: then(lambda a, b: and2_rest(t2, a, b), then_code, else_code), test2)
+            then_test(and2, test1)
+        elif fcn == LAMBDA:
+            names, body = args
+            def lambda_done(b):
+                unbind(names)
+                done.append([LAMBDA, names, b])
+            bind(names, [None]*len(names))
+            then(lambda_done, body)
+        elif fcn == LET:
+            names, values, body = args
+            def let(*values):
+                # Duplicate names resolve to their first binding; don't guess.
+                if len(set(names)) == len(names):
+                    consts = [v if type(v) == int else None for v in values]
+                else:
+                    consts = [None]*len(names)
+
+                def let_done(b):
+                    unbind(names)
+                    kept = [i for (i, c) in enumerate(consts) if c is None]
+                    if kept:
+                        done.append([LET, [names[i] for i in kept], [values[i] for i in kept], b])
+                    else:
+                        done.append(b)
+
+                bind(names, consts)
+                then(let_done, body)
+            then(let, *values)
+        elif fcn == LETREC:
+            names, values, body = args
+            def letrec_done(*parts):
+                unbind(names)
+                done.append([LETREC, names, list(parts[:-1]), parts[-1]])
+            bind(names, [None]*len(names))
+            then(letrec_done, *(values + [body]))
+        elif fcn == IOACTION:
+            done.append(e)
+        else: # builtin, LIST, or application of a named function
+            then(lambda *parts: done.append([fcn] + list(parts)), *args)
+
+    while work:
+        e = work.pop()
+        if callable(e):
+            e()
+        else:
+            visit(e)
+
+    assert len(done) == 1
+    return done[0]
+
+# Builtins with side effects, that can fail on valid arguments, that read
+# a vector (which VSET may change) or that make a new vector (whose identity
+# matters once it is set). The inliner does not move, drop or duplicate a
+# call to one of these.
+UNSAFE_BUILTINS = [WRITEI, WRITEC, WRITEB, DIV, MOD, CAR, CDR, NTH,
+                   VEC, VREF, VSET, VLEN, VADD, VSUM, EQUAL]
+
+# Expressions of at most this many nodes may be copied to several places
+# by the inliner.
+INLINE_MAX_SIZE = 20
+
+# Each round of inlining can expose new redexes; stop after this many.
+INLINE_ROUNDS = 4
+
+def subexpressions(e):
+    """
+    The immediate subexpressions of the list 'e', as pairs (x, names)
+    where 'names' are the identifiers bound around x by e. The
+    function of a named application counts as a subexpression.
+
+    >>> subexpressions([LET, ['x'], [1], [ADD, 'x', 'y']])
+    [(1, []), (['ADD', 'x', 'y'], ['x'])]
+    >>> subexpressions(['f', 1, 2])
+    [('f', []), (1, []), (2, [])]
+    """
+
+    fcn, args = e[0], e[1:]
+
+    if not is_atom(fcn):
+        return [(x, []) for x in e]
+    elif fcn == LAMBDA:
+        return [(args[1], args[0])]
+    elif fcn == LET:
+        return [(v, []) for v in args[1]] + [(args[2], args[0])]
+    elif fcn == LETREC:
+        return [(x, args[0]) for x in args[1] + [args[2]]]
+    elif fcn == IOACTION:
+        return []
+    elif is_builtin(fcn) or fcn in [LIST, IF, AND2]:
+        return [(x, []) for x in args]
+    else:
+        return [(fcn, [])] + [(x, []) for x in args]
+
+def rebuild(e, parts):
+    """
+    A copy of the list 'e' with its subexpressions, in the order given
+    by subexpressions(e), replaced by 'parts'.
+
+    >>> rebuild([LET, ['x'], [1], 'x'], [2, 'y'])
+    ['LET', ['x'], [2], 'y']
+    """
+
+    fcn = e[0]
+
+    if not is_atom(fcn):
+        return parts
+    elif fcn == LAMBDA:
+        return [LAMBDA, e[1], parts[0]]
+    elif fcn == LET or fcn == LETREC:
+        return [fcn, e[1], parts[:-1], parts[-1]]
+    elif fcn == IOACTION:
+        return e
+    elif is_builtin(fcn) or fcn in [LIST, IF, AND2]:
+        return [fcn] + parts
+    else:
+        return parts
+
+def is_identifier(e):
+    return type(e) == str and e != NIL
+
+def size(e):
+    """
+    Number of nodes in the expression 'e'.
+
+    >>> size([ADD, 1, [MUL, 'x', 2]])
+    7
+    """
+
+    n = 0
+    work = [e]
+    while work:
+        x = work.pop()
+        n += 1
+        if type(x) == list:
+            work.extend(x)
+    return n
+
+def free_variables(e):
+    """
+    The set of identifiers that occur free in 'e'.
+
+    >>> sorted(free_variables([LAMBDA, ['x'], ['f', 'x', [LET, ['y'], ['z'], 'y']]]))
+    ['f', 'z']
+    """
+
+    free = set()
+    work = [(e, frozenset())]
+
+    while work:
+        x, bound = work.pop()
+        if is_atom(x):
+            if is_identifier(x) and x not in bound:
+                free.add(x)
+        else:
+            for (y, names) in subexpressions(x):
+                work.append((y, bound.union(names) if names else bound))
+
+    return free
+
+def is_pure(e):
+    """
+    True if evaluating 'e' has no side effects and cannot fail, so
+    that it may be moved, dropped or duplicated. Building a closure is
+    pure whatever its body does; calling an unknown function is not.
+
+    >>> is_pure([ADD, 'x', [LAMBDA, ['y'], [WRITEI, 'y']]])
+    True
+    >>> is_pure([ADD, 'x', ['f', 1]])
+    False
+    """
+
+    work = [e]
+    while work:
+        x = work.pop()
+        if is_atom(x) or x[0] == LAMBDA:
+            continue
+        fcn = x[0]
+        if not (is_builtin(fcn) or fcn in [LIST, IF, AND2]) or fcn in UNSAFE_BUILTINS:
+            return False
+        work.extend(x[1:])
+    return True
+
+def uses(e, names):
+    """
+    The free occurrences in 'e' of each identifier in 'names', as a
+    dict from name to a list of pairs (bound, under_lambda): the names
+    bound around the occurrence and whether it is inside a LAMBDA.
+    None if 'e' contains an IOACTION, whose code we can't see into.
+
+    >>> uses([ADD, 'x', [LAMBDA, ['y'], 'x']], ['x', 'z'])
+    {'x': [(frozenset([]), False), (frozenset(['y']), True)], 'z': []}
+    """
+
+    found = dict((name, []) for name in names)
+    work  = [(e, frozenset(), False)]
+
+    while work:
+        x, bound, under_lambda = work.pop()
+        if is_atom(x):
+            if x in found and x not in bound:
+                found[x].append((bound, under_lambda))
+        elif x[0] == IOACTION:
+            return None
+        else:
+            for (y, inner) in reversed(subexpressions(x)):
+                work.append((y, bound.union(inner) if inner else bound,
+                             under_lambda or x[0] == LAMBDA))
+
+    return found
+
+def substitute(e, bindings):
+    """
+    Replace the free occurrences in 'e' of the names in the dict
+    'bindings' by their values. The caller makes sure that no free
+    variable of a value is captured by a binding in 'e'.
+
+    >>> substitute([ADD, 'x', [LAMBDA, ['x'], 'x']], {'x': 3})
+    ['ADD', 3, ['LAMBDA', ['x'], 'x']]
+    """
+
+    done = []
+    work = [(e, bindings)]
+
+    while work:
+        x, active = work.pop()
+
+        if active is None: # all x's parts are done
+            k = len(subexpressions(x))
+            parts = done[len(done) - k:]
+            del done[len(done) - k:]
+            done.append(rebuild(x, parts))
+            continue
+
+        if is_atom(x):
+            done.append(active.get(x, x) if is_identifier(x) else x)
+            continue
+
+        work.append((x, None))
+        for (y, names) in reversed(subexpressions(x)):
+            if any(name in active for name in names):
+                inner = dict(active)
+                for name in names:
+                    inner.pop(name, None)
+                work.append((y, inner))
+            else:
+                work.append((y, active))
+
+    return done[0]
+
+def transform(e, visit):
+    """
+    Rebuild the expression 'e' bottom up: every list in it is rebuilt
+    from its transformed subexpressions and then passed to 'visit',
+    which returns its replacement.
+
+    >>> transform([ADD, [ADD, 1, 2], 3], lambda x: [SUB] + x[1:])
+    ['SUB', ['SUB', 1, 2], 3]
+    """
+
+    done = []
+    work = [e]
+
+    while work:
+        x = work.pop()
+        if type(x) == tuple: # (k, x): all k parts of x are done
+            k, x = x
+            parts = done[len(done) - k:]
+            del done[len(done) - k:]
+            done.append(visit(rebuild(x, parts)))
+        elif is_atom(x):
+            done.append(x)
+        else:
+            parts = subexpressions(x)
+            work.append((len(parts), x))
+            work.extend(reversed([y for (y, _) in parts]))
+
+    return done[0]
+
+def inline_let(names, values, body):
+    """
+    Beta-reduce [LET, names, values, body] as far as is safe. A binding
+    is substituted into the body if its value is an atom, or a pure
+    expression used once outside any LAMBDA, or a LAMBDA that is used
+    once or is small; a pure value that is not used is dropped. Returns
+    the new expression.
+
+    >>> inline_let(['x', 'y'], [5, [WRITEI, 1]], [ADD, 'x', 'y'])
+    ['LET', ['y'], [['WRITEI', 1]], ['ADD', 5, 'y']]
+
+    A value is not moved where one of its free variables would be
+    captured:
+
+    >>> inline_let(['x'], ['y'], [LAMBDA, ['y'], 'x'])
+    ['LET', ['x'], ['y'], ['LAMBDA', ['y'], 'x']]
+
+    Nor is a read of a vector moved past a VSET of it:
+
+    >>> inline_let(['s'], [[VSUM, 'v']], [ADD, 's', [VREF, [VSET, 'v', 0, 5], 0]])
+    ['LET', ['s'], [['VSUM', 'v']], ['ADD', 's', ['VREF', ['VSET', 'v', 0, 5], 0]]]
+    """
+
+    if len(set(names)) != len(names):
+        return [LET, names, values, body]
+
+    found = uses(body, names)
+    if found is None:
+        return [LET, names, values, body]
+
+    inlined = {}
+    kept    = []
+
+    for (name, value) in zip(names, values):
+        occurrences = found[name]
+        fvs = free_variables(value)
+
+        if fvs.intersection(names) or \
+           any(fvs.intersection(bound) for (bound, _) in occurrences):
+            kept.append((name, value))
+        elif is_atom(value):
+            inlined[name] = value
+        elif not is_pure(value):
+            kept.append((name, value))
+        elif len(occurrences) == 0:
+            pass
+        elif value[0] == LAMBDA and (len(occurrences) == 1 or size(value) <= INLINE_MAX_SIZE):
+            inlined[name] = value
+        elif len(occurrences) == 1 and not occurrences[0][1]:
+            inlined[name] = value
+        else:
+            kept.append((name, value))
+
+    if inlined:
+        body = substitute(body, inlined)
+
+    if kept:
+        return [LET, [name for (name, _) in kept], [value for (_, value) in kept], body]
+    return body
+
+def inline(e):
+    """
+    Inline small non-recursive LETs and immediately applied LAMBDAs
+    (see inline_let()), saving the closure, argument list and dump
+    frame of each application. Substitution can expose new redexes,
+    so this takes up to INLINE_ROUNDS passes.
+
+    >>> inline([LET, ['x'], [5], [ADD, 'x', 1]])
+    ['ADD', 5, 1]
+    >>> inline([LET, ['inc'], [[LAMBDA, ['n'], [ADD, 'n', 1]]], [MUL, ['inc', 2], ['inc', 'k']]])
+    ['MUL', ['ADD', 2, 1], ['ADD', 'k', 1]]
+    >>> compile(optimise([[LAMBDA, ['x', 'y'], [SUB, 'x', 'y']], 'a', 7]), [['a']], [])
+    ['LDC', 7, 'LD', [1, 1], 'SUB']
+    """
+
+    for _ in range(INLINE_ROUNDS):
+        changed = [False]
+
+        def visit(x):
+            if not is_atom(x[0]) and x[0][0] == LAMBDA and len(x[0][1]) == len(x) - 1:
+                changed[0] = True
+                return inline_let(x[0][1], x[1:], x[0][2])
+            elif x[0] == LET:
+                y = inline_let(x[1], x[2], x[3])
+                if is_atom(y) or y[0] != LET or len(y[1]) < len(x[1]):
+                    changed[0] = True
+                return y
+            return x
+
+        e = transform(e, visit)
+        if not changed[0]:
+            break
+
+    return e
+
+def is_named_application(e):
+    """
+    True if 'e' is the application of a function by name, like ['f', 1].
+    """
+
+    return type(e) == list and is_identifier(e[0]) and \
+           not (is_builtin(e[0]) or e[0] in [LIST, IF, AND2, LAMBDA, LET, LETREC, IOACTION])
+
+def contains_ioaction(e):
+    work = [e]
+    while work:
+        x = work.pop()
+        if type(x) == list:
+            if x[0] == IOACTION:
+                return True
+            work.extend(x)
+    return False
+
+def rename(e):
+    """
+    Alpha-rename bound variables so that no name is bound twice in
+    'e', or bound and also free. The first binding of a name keeps it.
+
+    >>> rename([LAMBDA, ['x'], [ADD, 'y', [LET, ['x', 'y'], [1, 'x'], [MUL, 'x', 'y']]]])
+    ['LAMBDA', ['x'], ['ADD', 'y', ['LET', ['x_1', 'y_2'], [1, 'x'], ['MUL', 'x_1', 'y_2']]]]
+    """
+
+    taken   = set(free_variables(e))
+    counter = [0]
+
+    def fresh(name):
+        while True:
+            counter[0] += 1
+            new = '%s_%d' % (name, counter[0])
+            if new not in taken:
+                return new
+
+    done = []
+    work = [(e, {})]
+
+    while work:
+        x, active = work.pop()
+
+        if active is None: # all x's parts are done
+            k = len(subexpressions(x))
+            parts = done[len(done) - k:]
+            del done[len(done) - k:]
+            done.append(rebuild(x, parts))
+            continue
+
+        if is_atom(x):
+            done.append(active.get(x, x) if is_identifier(x) else x)
+            continue
+
+        if x[0] in [LAMBDA, LET, LETREC]:
+            names = []
+            inner = dict(active)
+            for name in x[1]:
+                new = fresh(name) if name in taken else name
+                taken.add(new)
+                inner[name] = new
+                names.append(new)
+            x = [x[0], names] + x[2:]
+
+        work.append((x, None))
+        for (y, names) in reversed(subexpressions(x)):
+            work.append((y, inner if names else active))
+
+    return done[0]
+
+def lift(e):
+    """
+    Lambda lifting. A function bound by a LET or LETREC that is only
+    ever called directly, never passed around, is moved to a LETREC
+    around the whole program, and takes the variables it used from its
+    surroundings as extra parameters. Its variables are then all found
+    in the first frame of the environment, and its closure holds just
+    the global frame instead of the whole environment where it was
+    defined.
+
+    >>> e = [LAMBDA, ['n'],
+    ...       [LETREC, ['loop'], [[LAMBDA, ['i', 'acc'],
+    ...                             [IF, [ZEROP, 'i'], 'acc', ['loop', [SUB, 'i', 1], [ADD, 'acc', 'n']]]]],
+    ...        ['loop', 'n', 0]]]
+    >>> lift(e)
+    ['LETREC', ['loop'], [['LAMBDA', ['i', 'acc', 'n'], ['IF', ['ZEROP', 'i'], 'acc', ['loop', ['SUB', 'i', 1], ['ADD', 'acc', 'n'], 'n']]]], ['LAMBDA', ['n'], ['loop', 'n', 0, 'n']]]
+
+    >>> s = SECD()
+    >>> s.halt_stream = None
+    >>> s.load_program(compile([optimise(e), 12], [], [STOP]))
+    >>> s.run()
+    144
+    """
+
+    if contains_ioaction(e):
+        return e
+
+    e = rename(e)
+    outside = free_variables(e)
+
+    # Functions bound by a LET or LETREC, and how each name is used.
+    defs     = {}
+    arities  = {}
+    escaping = set()
+
+    work = [e]
+    while work:
+        x = work.pop()
+        if is_atom(x):
+            if is_identifier(x):
+                escaping.add(x)
+            continue
+
+        parts = [y for (y, _) in subexpressions(x)]
+        if x[0] in [LET, LETREC]:
+            for (name, value) in zip(x[1], x[2]):
+                if type(value) == list and value[0] == LAMBDA:
+                    defs[name] = value
+        elif is_named_application(x):
+            arities.setdefault(x[0], set()).add(len(x) - 1)
+            parts = parts[1:]
+        work.extend(parts)
+
+    lifted = set(name for (name, f) in defs.items()
+                 if name not in escaping and arities.get(name, set()) <= set([len(f[1])]))
+    if not lifted:
+        return e
+
+    # The extra parameters of a lifted function: its free variables, and
+    # those of the lifted functions it calls.
+    extra = {}
+    calls = {}
+    for name in lifted:
+        fvs = free_variables(defs[name])
+        extra[name] = fvs - lifted - outside
+        calls[name] = fvs & lifted
+
+    changed = True
+    while changed:
+        changed = False
+        for name in lifted:
+            for g in calls[name]:
+                if not extra[g] <= extra[name]:
+                    extra[name] |= extra[g]
+                    changed = True
+
+    for name in lifted:
+        extra[name] = sorted(extra[name])
+
+    definitions = {}
+
+    def visit(x):
+        if is_named_application(x) and x[0] in lifted:
+            return x + extra[x[0]]
+        elif x[0] in [LET, LETREC]:
+            keep = [i for (i, name) in enumerate(x[1]) if name not in lifted]
+            for (name, value) in zip(x[1], x[2]):
+                if name in lifted:
+                    definitions[name] = [LAMBDA, value[1] + extra[name], value[2]]
+            if not keep:
+                return x[3]
+            return [x[0], [x[1][i] for i in keep], [x[2][i] for i in keep], x[3]]
+        return x
+
+    e = transform(e, visit)
+
+    names = sorted(lifted)
+    return [LETREC, names, [definitions[name] for name in names], e]
+
+# Optimisation passes run by optimise(), in order.
+PASSES = [fold, inline, fold, lift]
+
+def optimise(e):
+    """
+    Run the optimisation passes over the expression 'e'. The result
+    compiles to code that computes the same value as 'e' with fewer
+    instructions:
+
+    >>> e = [LET, ['n'], [10], [IF, [GT0P, 'n'], [MUL, 'n', [ADD, 'n', 1]], 0]]
+    >>> print compile(e, [], [STOP])
+    ['LDC', 10, 'LDF', ['LD', [1, 1], 'BRGT0', ['LDC', 1, 'LD', [1, 1], 'ADD', 'LD', [1, 1], 'MUL', 'JOIN'], ['LDC', 0, 'JOIN'], 'RTN'], 'AP1', 'STOP']
+    >>> print compile(optimise(e), [], [STOP])
+    ['LDC', 110, 'STOP']
+    """
+
+    for optimisation in PASSES:
+        e = optimisation(e)
+    return e
 
 if __name__ == '__main__':
     print 'boo'
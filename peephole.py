@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+"""
+Peephole optimiser for SECD code, run on the output of compile()
+before it is given to load_program():
+
+    code = peephole(compile(e, [], [WRITEI, STOP]))
+
+Each rule looks at the instructions starting at one position of a code
+list and may replace them. The rules are listed in PEEPHOLE_RULES; pass
+your own list to peephole() to add or leave out rules.
+"""
+
+from compiler import *
+
+# Number of operands that follow each opcode; others have none.
+OPERANDS = {LDC: 1, LD: 1, LDF: 1, APN: 1, SEL: 2,
+            BRZ: 2, BRGT0: 2, BRLT0: 2, BRNULL: 2}
+
+# Opcodes whose operands are code lists.
+BLOCK_OPCODES = [LDF, SEL, BRZ, BRGT0, BRLT0, BRNULL]
+
+# Opcodes that select one of the two code lists following them, and the
+# test each one applies to a constant.
+SELECTS = {SEL:    lambda x: type(x) == int and x != 0,
+           BRZ:    lambda x: type(x) == int and x == 0,
+           BRGT0:  lambda x: type(x) == int and x > 0,
+           BRLT0:  lambda x: type(x) == int and x < 0,
+           BRNULL: lambda x: x == []}
+
+def instruction_count(code):
+    """
+    Number of instructions in 'code', including those in nested code
+    lists but not counting operands.
+
+    >>> instruction_count([LDC, 1, SEL, [LDC, 2, JOIN], [LDC, 3, JOIN], STOP])
+    7
+    """
+
+    n = 0
+    work = [code]
+    while work:
+        block = work.pop()
+        i = 0
+        while i < len(block):
+            op = block[i]
+            n += 1
+            if op in BLOCK_OPCODES:
+                work.extend(block[i + 1:i + 1 + OPERANDS[op]])
+            i += 1 + OPERANDS.get(op, 0)
+    return n
+
+def is_constant_list_item(x):
+    return type(x) == int or (type(x) == list and all(is_constant_list_item(y) for y in x))
+
+def constant_operand(code, i):
+    """
+    The constant pushed by the instruction at code[i] (NIL pushes the
+    empty list), or None.
+    """
+
+    if code[i] == NIL:
+        return []
+    if code[i] == LDC and i + 1 < len(code) and is_constant_list_item(code[i + 1]):
+        return code[i + 1]
+    return None
+
+def rule_constant_list(code, i):
+    """
+    A list built by consing constants onto a constant list is itself
+    a constant: NIL, LDC 3, CONS, LDC 2, CONS becomes LDC [2, 3].
+
+    >>> rule_constant_list([NIL, LDC, 3, CONS, STOP], 0)
+    (4, ['LDC', [3]])
+    >>> rule_constant_list([LDC, [3], LDC, 2, CONS], 0)
+    (5, ['LDC', [2, 3]])
+    """
+
+    tail = constant_operand(code, i)
+    if type(tail) != list:
+        return None
+
+    j = i + (1 if code[i] == NIL else 2)
+    if j + 2 < len(code) and code[j] == LDC and code[j + 2] == CONS:
+        head = constant_operand(code, j)
+        if head is not None:
+            return (j + 3 - i, [LDC, [head] + tail])
+    return None
+
+def rule_tail_join(code, i):
+    """
+    A selection followed by RTN at the end of a function can return
+    from its branches directly: SEL [.. JOIN] [.. JOIN] RTN becomes
+    SEL [.. RTN] [.. RTN]. The machine saves no join point for a
+    selection with no code after it.
+
+    >>> rule_tail_join([SEL, [LDC, 1, JOIN], [LDC, 2, JOIN], RTN], 0)
+    (4, ['SEL', ['LDC', 1, 'RTN'], ['LDC', 2, 'RTN']])
+    """
+
+    if code[i] in SELECTS and i + 4 == len(code) and code[i + 3] == RTN:
+        branches = code[i + 1:i + 3]
+        if all(type(b) == list and b and b[-1] == JOIN for b in branches):
+            return (4, [code[i]] + [b[:-1] + [RTN] for b in branches])
+    return None
+
+def rule_constant_branch(code, i):
+    """
+    A selection on a constant always takes the same branch, so the
+    constant and the other branch are dead: LDC 0, BRZ, [a, JOIN], [b,
+    JOIN] becomes a.
+
+    >>> rule_constant_branch([LDC, 0, BRZ, [LDC, 1, JOIN], [LDC, 2, JOIN], STOP], 0)
+    (5, ['LDC', 1])
+    """
+
+    value = constant_operand(code, i)
+    if value is None:
+        return None
+
+    j = i + (1 if code[i] == NIL else 2)
+    if j + 2 < len(code) and code[j] in SELECTS:
+        branch = code[j + 1] if SELECTS[code[j]](value) else code[j + 2]
+        if type(branch) != list or not branch:
+            return None
+        if branch[-1] == JOIN:
+            return (j + 3 - i, branch[:-1])
+        if branch[-1] == RTN and j + 3 == len(code): # tail position
+            return (j + 3 - i, branch)
+    return None
+
+# The rules tried at each position, in order, with their names.
+PEEPHOLE_RULES = [('constant_list',   rule_constant_list),
+                  ('tail_join',       rule_tail_join),
+                  ('constant_branch', rule_constant_branch)]
+
+def peephole(code, rules=PEEPHOLE_RULES, stats=None):
+    """
+    Return an optimised copy of the SECD program 'code'. If 'stats' is
+    a dict, the number of instructions removed by each rule is added
+    to stats[name].
+
+    >>> e = [LETREC, ['f'], [[LAMBDA, ['n'], [IF, [ZEROP, 'n'], [LIST, 1, 2, 3],
+    ...                                        [IF, 1, ['f', [SUB, 'n', 1]], 0]]]],
+    ...      ['f', 3]]
+    >>> code = compile(e, [], [STOP])
+    >>> stats = {}
+    >>> fast = peephole(code, stats=stats)
+    >>> fast
+    ['DUM', 'NIL', 'LDF', ['LD', [1, 1], 'BRZ', ['LDC', [1, 2, 3], 'RTN'], ['LDC', 1, 'LD', [1, 1], 'SUB', 'LD', [2, 1], 'AP1', 'RTN']], 'CONS', 'LDF', ['LDC', 3, 'LD', [1, 1], 'AP1', 'RTN'], 'RAP', 'STOP']
+    >>> sorted(stats.items())
+    [('constant_branch', 5), ('constant_list', 6), ('tail_join', 1)]
+
+    Both versions compute the same value:
+
+    >>> results = []
+    >>> for program in [code, fast]:
+    ...     s = SECD()
+    ...     s.halt_stream = None
+    ...     s.load_program(program)
+    ...     results.append(s.run())
+    >>> results
+    [[1, 2, 3], [1, 2, 3]]
+    """
+
+    code   = list(code)
+    work   = [code]       # code lists still to be optimised, in place
+    copied = set([id(code)])
+
+    while work:
+        block = work.pop()
+        starts = [] # positions of the instructions before i
+        i = 0
+
+        while i < len(block):
+            for (name, rule) in rules:
+                rewrite = rule(block, i)
+                if rewrite is not None:
+                    break
+            else:
+                rewrite = None
+
+            if rewrite is not None:
+                k, replacement = rewrite
+                if stats is not None:
+                    stats[name] = stats.get(name, 0) + \
+                                  instruction_count(block[i:i + k]) - instruction_count(replacement)
+                block[i:i + k] = replacement
+                if starts: # the rewrite may complete a pattern that starts earlier
+                    i = starts.pop()
+                continue
+
+            op = block[i]
+            if op in BLOCK_OPCODES:
+                for j in range(i + 1, i + 1 + OPERANDS[op]):
+                    if id(block[j]) not in copied: # don't change the caller's code
+                        block[j] = list(block[j])
+                        copied.add(id(block[j]))
+                        work.append(block[j])
+            starts.append(i)
+            i += 1 + OPERANDS.get(op, 0)
+
+    return code
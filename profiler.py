@@ -0,0 +1,522 @@
+#!/usr/bin/env python
+
+"""
+Profilers for the SECD machine. Each one runs a loaded machine to
+completion in place of SECD.run(), so the plain run loop pays nothing
+for profiling that is not asked for. OpcodeProfiler and
+FunctionProfiler record every step; SamplingProfiler is cheap enough
+to leave on. They are used like this:
+
+    s.load_program(code)
+    profiler = OpcodeProfiler()
+    value = profiler.run(s)
+    print profiler.table()
+"""
+
+import json
+import threading
+import time
+from collections import OrderedDict
+from timeit import default_timer
+
+from compiler import *
+
+class OpcodeProfiler:
+    """
+    Counts, wall time and cells allocated per opcode. Cells are
+    counted from get_new_address(), so a dump cell that RTN puts back
+    on the free list is not counted again when it is reused.
+
+    >>> code = compile([LETREC, ['f'], [[LAMBDA, ['n'], [IF, [ZEROP, 'n'], 0, ['f', [SUB, 'n', 1]]]]], ['f', 3]],
+    ...                [], [STOP])
+    >>> s = SECD()
+    >>> s.halt_stream = None
+    >>> s.load_program(code)
+    >>> profiler = OpcodeProfiler()
+    >>> profiler.run(s)
+    0
+    >>> profiler.counts[AP1], profiler.counts[RTN], profiler.cells[RTN]
+    (4, 5, 0)
+    >>> print profiler.table(key='count', limit=3) # doctest: +ELLIPSIS
+    opcode        count      seconds    us/op      cells
+    LD               11 ...
+    LDC               5 ...
+    RTN               5 ...
+    >>> json.loads(profiler.json())['SUB']['count']
+    3
+    """
+
+    def __init__(self, clock=default_timer):
+        self.clock = clock
+
+        self.counts  = {} # opcode -> number of times it ran
+        self.seconds = {} # opcode -> total wall time
+        self.cells   = {} # opcode -> cells allocated
+
+    def run(self, machine):
+        """
+        Run 'machine' until it halts, recording each opcode, and return
+        its result like SECD.run().
+        """
+
+        counts  = self.counts
+        seconds = self.seconds
+        cells   = self.cells
+        clock   = self.clock
+
+        while machine.running:
+            op = machine.get_int(machine.car(machine.registers['C']))
+            used = machine.max_used_address
+
+            start = clock()
+            machine.execute_opcode()
+            elapsed = clock() - start
+
+            counts[op]  = counts.get(op, 0) + 1
+            seconds[op] = seconds.get(op, 0.0) + elapsed
+            cells[op]   = cells.get(op, 0) + machine.max_used_address - used
+
+        return machine.result()
+
+    def rows(self, key='seconds'):
+        """
+        (opcode, count, seconds, cells) for each opcode that ran, the
+        largest 'key' first.
+        """
+
+        rows = [(op, self.counts[op], self.seconds[op], self.cells[op]) for op in self.counts]
+        column = {'count': 1, 'seconds': 2, 'cells': 3}[key]
+        rows.sort(key=lambda row: (-row[column], row[0]))
+        return rows
+
+    def table(self, key='seconds', limit=None):
+        """
+        The profile as a text table sorted by 'key', which is one of
+        'count', 'seconds' or 'cells'.
+        """
+
+        lines = ['%-8s %10s %12s %8s %10s' % ('opcode', 'count', 'seconds', 'us/op', 'cells')]
+        for (op, count, seconds, cells) in self.rows(key)[:limit]:
+            lines.append('%-8s %10d %12.6f %8.2f %10d' % (op, count, seconds, 1e6*seconds/count, cells))
+        return '\n'.join(lines)
+
+    def json(self):
+        """
+        The profile as a JSON object mapping each opcode to its count,
+        seconds and cells.
+        """
+
+        return json.dumps(dict((op, {'count':   self.counts[op],
+                                     'seconds': self.seconds[op],
+                                     'cells':   self.cells[op]}) for op in self.counts),
+                          sort_keys=True)
+
+# Opcodes that may enter a closure; whether they did is seen from the dump.
+CALL_OPCODES = [AP, AP1, AP2, APN, RAP]
+
+# Name of the code that is not inside any function.
+TOP_LEVEL = 'top'
+
+class FunctionProfiler:
+    """
+    Steps and cells allocated per function, and the call graph. A
+    function is named by names[code], where code is the address of the
+    code of its closure (what LDF loads), or else by the name its
+    source gives, if the program was loaded with a source map, or else
+    'lambda@code'.
+
+    Costs are recorded against the chain of calls that was active, as
+    a tree with one node per distinct chain, so collapsed() can write
+    them out for flamegraph tools.
+
+    >>> code = compile([LETREC, ['even', 'odd'],
+    ...                 [[LAMBDA, ['n'], [IF, [ZEROP, 'n'], 1, ['odd',  [SUB, 'n', 1]]]],
+    ...                  [LAMBDA, ['n'], [IF, [ZEROP, 'n'], 0, ['even', [SUB, 'n', 1]]]]],
+    ...                 ['even', 3]], [], [STOP])
+    >>> s = SECD()
+    >>> s.halt_stream = None
+    >>> s.load_program(code)
+    >>> profiler = FunctionProfiler()
+    >>> profiler.run(s)
+    0
+    >>> print profiler.table()
+    function           calls      steps   cumulative      cells
+    top                    0          9           45         13
+    lambda@120             1          4           36          6
+    lambda@66              2         18           32         20
+    lambda@12              2         14           23         12
+    >>> print profiler.call_graph()
+    caller             callee             calls
+    lambda@12          lambda@66              1
+    lambda@120         lambda@66              1
+    lambda@66          lambda@12              2
+    top                lambda@120             1
+    >>> print profiler.collapsed()
+    top 9
+    top;lambda@120 4
+    top;lambda@120;lambda@66 9
+    top;lambda@120;lambda@66;lambda@12 9
+    top;lambda@120;lambda@66;lambda@12;lambda@66 9
+    top;lambda@120;lambda@66;lambda@12;lambda@66;lambda@12 5
+
+    With a source map, functions bound by a LET or LETREC are named:
+
+    >>> e = [LETREC, ['even', 'odd'],
+    ...      [[LAMBDA, ['n'], [IF, [ZEROP, 'n'], 1, ['odd',  [SUB, 'n', 1]]]],
+    ...       [LAMBDA, ['n'], [IF, [ZEROP, 'n'], 0, ['even', [SUB, 'n', 1]]]]],
+    ...      ['even', 3]]
+    >>> source_map = {}
+    >>> code = compile(e, [], [STOP], source_map)
+    >>> s = SECD()
+    >>> s.halt_stream = None
+    >>> s.load_program(code, [], source_map)
+    >>> profiler = FunctionProfiler()
+    >>> profiler.run(s)
+    0
+    >>> print profiler.call_graph()
+    caller             callee             calls
+    even               odd                    2
+    lambda@120         even                   1
+    odd                even                   1
+    top                lambda@120             1
+    """
+
+    def __init__(self, names=None):
+        self.names = names if names is not None else {}
+
+        # The call tree. Node 0 is the top level; node k has the label
+        # labels[k] and the parent parents[k], and is entered from its
+        # parent children[(parent, label)] = k.
+        self.labels    = [TOP_LEVEL]
+        self.parents   = [None]
+        self.children  = {}
+        self.recursive = [False] # the label is also on the chain above the node
+
+        self.steps = [0] # opcodes run in each node itself
+        self.cells = [0] # cells allocated in each node itself
+
+        self.calls = {} # (caller, callee) -> number of calls
+
+        self.source = {} # the machine's source map, see SECD.load_program()
+
+    def label(self, code):
+        if code in self.names:
+            return self.names[code]
+        function = self.source.get(code, (None, None))[0]
+        if function is not None:
+            return function
+        return 'lambda@%d' % code
+
+    def child(self, node, label, active):
+        key = (node, label)
+        if key not in self.children:
+            self.children[key] = len(self.labels)
+            self.labels.append(label)
+            self.parents.append(node)
+            self.recursive.append(active.get(label, 0) > 0)
+            self.steps.append(0)
+            self.cells.append(0)
+        return self.children[key]
+
+    def run(self, machine):
+        """
+        Run 'machine' until it halts and return its result like
+        SECD.run().
+        """
+
+        stack  = [0]            # call tree nodes of the active calls
+        active = {TOP_LEVEL: 1} # label -> number of times on the stack
+
+        self.source = machine.source
+
+        while machine.running:
+            op = machine.get_int(machine.car(machine.registers['C']))
+
+            callee = None
+            if op in CALL_OPCODES:
+                code, _ = machine.get_closure(machine.car(machine.registers['S']))
+                callee = self.label(code)
+
+            dump = machine.registers['D']
+            used = machine.max_used_address
+
+            machine.execute_opcode()
+
+            node = stack[-1]
+            self.steps[node] += 1
+            self.cells[node] += machine.max_used_address - used
+
+            if callee is not None and machine.registers['D'] != dump: # not answered by the memo table
+                edge = (self.labels[node], callee)
+                self.calls[edge] = self.calls.get(edge, 0) + 1
+                stack.append(self.child(node, callee, active))
+                active[callee] = active.get(callee, 0) + 1
+            elif op == RTN:
+                active[self.labels[stack.pop()]] -= 1
+
+        return machine.result()
+
+    def functions(self):
+        """
+        (name, calls, steps, cumulative steps, cells) for each function,
+        the largest cumulative steps first. Cumulative steps include
+        the functions called, counting recursive calls only once.
+        """
+
+        # Nodes are made after their parents, so one backward pass sums
+        # each subtree.
+        total = list(self.steps)
+        for k in range(len(total) - 1, 0, -1):
+            total[self.parents[k]] += total[k]
+
+        stats = {}
+        for (k, label) in enumerate(self.labels):
+            row = stats.setdefault(label, [0, 0, 0, 0])
+            row[1] += self.steps[k]
+            row[3] += self.cells[k]
+            if not self.recursive[k]:
+                row[2] += total[k]
+        for ((_, callee), n) in self.calls.items():
+            stats[callee][0] += n
+
+        rows = [(label,) + tuple(row) for (label, row) in stats.items()]
+        rows.sort(key=lambda row: (-row[3], row[0]))
+        return rows
+
+    def table(self, limit=None):
+        """
+        The profile of each function as a text table.
+        """
+
+        lines = ['%-14s %9s %10s %12s %10s' % ('function', 'calls', 'steps', 'cumulative', 'cells')]
+        for row in self.functions()[:limit]:
+            lines.append('%-14s %9d %10d %12d %10d' % row)
+        return '\n'.join(lines)
+
+    def call_graph(self):
+        """
+        The number of calls from each caller to each callee, as a text
+        table.
+        """
+
+        lines = ['%-18s %-14s %9s' % ('caller', 'callee', 'calls')]
+        for ((caller, callee), n) in sorted(self.calls.items()):
+            lines.append('%-18s %-14s %9d' % (caller, callee, n))
+        return '\n'.join(lines)
+
+    def collapsed(self, merge_recursion=False):
+        """
+        The steps of each chain of calls in the collapsed stack format
+        read by flamegraph.pl and similar tools: the names on the chain
+        separated by ';', a space, and the count. A deep recursion
+        makes a chain per level; with merge_recursion a function that
+        calls itself directly is shown once, which keeps the output
+        linear in the depth.
+        """
+
+        paths = [TOP_LEVEL]
+        steps = OrderedDict([(TOP_LEVEL, self.steps[0])])
+        for k in range(1, len(self.labels)):
+            parent = self.parents[k]
+            if merge_recursion and self.labels[k] == self.labels[parent]:
+                path = paths[parent]
+            else:
+                path = paths[parent] + ';' + self.labels[k]
+            paths.append(path)
+            steps[path] = steps.get(path, 0) + self.steps[k]
+
+        return '\n'.join('%s %d' % (path, n) for (path, n) in steps.items() if n > 0)
+
+class SamplingProfiler:
+    """
+    Records where the machine is, every 'every' instructions or, if
+    'interval' is given, every 'interval' seconds from a timer thread.
+    The cost to the run loop is a counter per instruction, or nothing
+    at all with the timer, so it can be left on for long runs. With
+    'depth' the profiler also counts the calls and returns of the
+    machine it runs; a machine that is not being profiled keeps no
+    count. A
+    sample is the address in C, the number of calls in progress if
+    'depth' is set, and the return addresses saved on the dump,
+    innermost first, if 'chain' is set. Only the innermost max_chain
+    return addresses are kept, so that a sample deep in a recursion
+    stays cheap.
+
+    Sampling every 1000 instructions, or every 0.01 seconds, adds less
+    than 2% to the running time.
+
+    If the program was loaded with a source map, table() shows the
+    function that each address is in.
+
+    >>> source_map = {}
+    >>> code = compile([LETREC, ['f'], [[LAMBDA, ['n'], [IF, [ZEROP, 'n'], 0, [ADD, 1, ['f', [SUB, 'n', 1]]]]]],
+    ...                 ['f', 100]], [], [STOP], source_map)
+    >>> s = SECD(10000)
+    >>> s.halt_stream = None
+    >>> s.load_program(code, [], source_map)
+    >>> profiler = SamplingProfiler(every=10, depth=True)
+    >>> profiler.run(s)
+    100
+    >>> sum(profiler.samples.values())
+    111
+    >>> print profiler.table(limit=3)
+    address   opcode   function     samples  percent
+    57        LDC      f                 20     18.0
+    63        JOIN     f                 20     18.0
+    17        BRZ      f                 11      9.9
+    >>> max(profiler.depths())
+    102
+    """
+
+    def __init__(self, every=1000, interval=None, depth=False, chain=False, max_chain=100):
+        self.every     = every
+        self.interval  = interval
+        self.depth     = depth
+        self.chain     = chain
+        self.max_chain = max_chain
+
+        self.samples = {} # (address, depth, return addresses) -> number of samples
+        self.opcodes = {} # address -> opcode there
+        self.sources = {} # address -> its source in the machine's source map, or None
+
+    def sample(self, machine):
+        c = machine.registers['C']
+        if c not in self.opcodes:
+            # The timer may catch an opcode half way through changing C,
+            # so don't assume that c is the start of an instruction.
+            cell = machine.memory[c]
+            head = machine.memory[cell[1]] if cell[0] == TAG_NONTERMINAL else None
+            self.opcodes[c] = head[1] if head is not None and head[0] == TAG_INTEGER else '?'
+            self.sources[c] = machine.source.get(c)
+
+        depth   = self.dump_depth if self.depth else None
+        returns = None
+        if self.chain:
+            returns = []
+            d = machine.registers['D']
+            while machine.memory[d][0] == TAG_DUMP and len(returns) < self.max_chain:
+                returns.append(machine.memory[d][3])
+                d = machine.memory[d][4]
+            returns = tuple(returns)
+
+        key = (c, depth, returns)
+        self.samples[key] = self.samples.get(key, 0) + 1
+
+    def run(self, machine):
+        """
+        Run 'machine' until it halts and return its result like
+        SECD.run().
+        """
+
+        if self.depth:
+            self.count_depth(machine)
+        try:
+            if self.interval is not None:
+                return self.run_with_timer(machine)
+
+            every = self.every
+            while machine.running:
+                for _ in xrange(every):
+                    if not machine.running:
+                        break
+                    machine.execute_opcode()
+                else:
+                    self.sample(machine)
+
+            return machine.result()
+        finally:
+            if self.depth:
+                del machine.push_dump, machine.pop_dump
+
+    def count_depth(self, machine):
+        # Keep the number of cells on the dump in self.dump_depth, by
+        # wrapping push_dump() and pop_dump() of this machine only, so
+        # that the machine itself keeps no count.
+        self.dump_depth = 0
+        d = machine.registers['D']
+        while machine.memory[d][0] == TAG_DUMP:
+            self.dump_depth += 1
+            d = machine.memory[d][4]
+
+        push_dump = machine.push_dump
+        pop_dump  = machine.pop_dump
+
+        def counted_push_dump(s, e, c):
+            push_dump(s, e, c)
+            self.dump_depth += 1
+
+        def counted_pop_dump():
+            self.dump_depth -= 1
+            return pop_dump()
+
+        machine.push_dump = counted_push_dump
+        machine.pop_dump  = counted_pop_dump
+
+    def run_with_timer(self, machine):
+        # The timer thread reads the registers while the machine runs.
+        # A sample may see a dump cell that is being reused, so the
+        # chain of return addresses is cut at max_chain.
+        stop = []
+
+        def sampler():
+            while not stop:
+                time.sleep(self.interval)
+                if machine.running and not stop:
+                    self.sample(machine)
+
+        thread = threading.Thread(target=sampler)
+        thread.daemon = True
+        thread.start()
+        try:
+            return machine.run()
+        finally:
+            stop.append(True)
+            thread.join()
+
+    def histogram(self):
+        """
+        The number of samples at each code address.
+        """
+
+        counts = {}
+        for ((c, _, _), n) in self.samples.items():
+            counts[c] = counts.get(c, 0) + n
+        return counts
+
+    def depths(self):
+        """
+        The number of samples at each depth of calls, if 'depth' is set.
+        """
+
+        counts = {}
+        for ((_, depth, _), n) in self.samples.items():
+            counts[depth] = counts.get(depth, 0) + n
+        return counts
+
+    def table(self, limit=None):
+        """
+        The hottest code addresses, as a text table.
+        """
+
+        counts = self.histogram()
+        total  = sum(counts.values())
+        rows   = sorted(counts.items(), key=lambda (c, n): (-n, c))
+
+        lines = ['%-9s %-8s %-10s %9s %8s' % ('address', 'opcode', 'function', 'samples', 'percent')]
+        for (c, n) in rows[:limit]:
+            source = self.sources[c]
+            function = source[0] if source is not None and source[0] is not None else '-'
+            lines.append('%-9d %-8s %-10s %9d %8.1f' % (c, self.opcodes[c], function, n, 100.0*n/total))
+        return '\n'.join(lines)
+
+    def collapsed(self):
+        """
+        Samples taken with 'chain' set in the collapsed stack format:
+        the return addresses, outermost first, then the address in C.
+        """
+
+        counts = {}
+        for ((c, _, returns), n) in self.samples.items():
+            path = ';'.join(['%d' % a for a in reversed(returns or ())] + ['%d' % c])
+            counts[path] = counts.get(path, 0) + n
+        return '\n'.join('%s %d' % item for item in sorted(counts.items()))
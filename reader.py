@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+"""
+Reader for a Lisp surface syntax. Turns text like
+
+    (letrec (f) ((lambda (x m) (if (null x) m (f (cdr x) (+ m 1)))))
+      (f (list 1 2 3) 0))
+
+into the nested lists that compiler.compile() accepts. The source is
+read in chunks and parsed in a single pass without recursion, so large
+files can be read one top-level form at a time.
+
+Symbols that name a keyword or builtin of the compiler (in any case)
+are read as that keyword, integers as ints and everything else as an
+identifier. () is the empty list of names or values of a LAMBDA, LET
+or LETREC, and NIL anywhere else. A ; starts a comment that runs to
+the end of the line.
+"""
+
+import re
+from StringIO import StringIO
+
+from compiler import *
+
+# Source is read from the stream this many characters at a time.
+READ_CHUNK_SIZE = 65536
+
+# A parenthesis, a comment, or an atom.
+TOKEN_RE   = re.compile(r'[()]|;[^\n]*|[^\s();]+')
+INTEGER_RE = re.compile(r'-?\d+$')
+
+# Symbols that are read as keywords of the compiler.
+KEYWORDS = dict((k, k) for k in [IF, NULL, NIL, LAMBDA, LET, LETREC, LIST, AND2, DEFINE,
+                                 GET, PUT, RETURN, IOACTION] + BUILTINS)
+KEYWORDS.update({'+': ADD, '-': SUB, '*': MUL, '/': DIV, '%': MOD,
+                 '=': EQ, '<': LT, '<=': LE, '>': GT, '>=': GE})
+
+def tokenize(stream, chunk_size=READ_CHUNK_SIZE):
+    """
+    Generate the tokens of the text in the file-like object 'stream',
+    skipping whitespace and comments. A token that is split across two
+    chunks is held back until the rest of it has been read.
+
+    >>> list(tokenize(StringIO('(add 1 ; one\\n  x)'), chunk_size=3))
+    ['(', 'add', '1', 'x', ')']
+    """
+
+    pending = ''
+
+    while True:
+        chunk = stream.read(chunk_size)
+        text  = pending + chunk
+        pending = ''
+
+        for m in TOKEN_RE.finditer(text):
+            token = m.group()
+
+            if chunk and m.end() == len(text) and token not in '()':
+                pending = token # may continue in the next chunk
+            elif token[0] != ';':
+                yield token
+
+        if not chunk:
+            return
+
+def atom(token):
+    """
+    The value of an atom token.
+
+    >>> atom('42'), atom('-7'), atom('-'), atom('lambda'), atom('foo')
+    (42, -7, 'SUB', 'LAMBDA', 'foo')
+    """
+
+    if INTEGER_RE.match(token):
+        return int(token)
+    return KEYWORDS.get(token.upper(), token)
+
+def is_names_position(form):
+    """
+    True if the next element of the partly read 'form' is the list of
+    names or values of a LAMBDA, LET or LETREC, rather than an
+    expression.
+    """
+
+    return (form[:1] == [LAMBDA] and len(form) == 1) or \
+           (form[:1] in [[LET], [LETREC]] and len(form) in [1, 2])
+
+def read_forms(stream, chunk_size=READ_CHUNK_SIZE):
+    """
+    Generate the top-level forms in the file-like object 'stream', one
+    at a time, as they are read.
+
+    >>> forms = read_forms(StringIO('(lambda (x) (+ x 1)) 3 ()'))
+    >>> forms.next()
+    ['LAMBDA', ['x'], ['ADD', 'x', 1]]
+    >>> list(forms)
+    [3, 'NIL']
+
+    >>> read('(let () () (car ()))')
+    ['LET', [], [], ['CAR', 'NIL']]
+
+    >>> list(read_forms(StringIO('(car (list 1 2)')))
+    Traceback (most recent call last):
+    ...
+    AssertionError: unexpected end of input: 1 unclosed '('
+    """
+
+    stack = [] # lists still open, innermost last
+
+    for token in tokenize(stream, chunk_size):
+        if token == '(':
+            stack.append([])
+            continue
+
+        if token == ')':
+            assert stack, "unexpected ')'"
+            x = stack.pop()
+            if x == [] and not (stack and is_names_position(stack[-1])):
+                x = NIL
+        else:
+            x = atom(token)
+
+        if stack:
+            stack[-1].append(x)
+        else:
+            yield x
+
+    assert not stack, "unexpected end of input: %d unclosed '('" % len(stack)
+
+def read(text):
+    """
+    Read the first form in the string 'text'.
+
+    >>> code = compile(read('''
+    ...     (letrec (f) ((lambda (x m) (if (null x) m (f (cdr x) (+ m 1)))))
+    ...       (f (list 1 2 3) 0))'''), [], [WRITEI, STOP])
+    >>> s = SECD()
+    >>> s.load_program(code)
+    >>> while s.running: s.execute_opcode()
+    3
+    <BLANKLINE>
+    MACHINE HALTED!
+    <BLANKLINE>
+    """
+
+    for form in read_forms(StringIO(text)):
+        return form
+    assert False, 'no form in input'
+
+def read_file(filename):
+    """
+    Generate the top-level forms in the source file 'filename'.
+    """
+
+    f = open(filename)
+    try:
+        for form in read_forms(f):
+            yield form
+    finally:
+        f.close()
@@ -3,3 +3,13 @@
 echo '42' | python -m doctest secd.py
 
 python -m doctest compiler.py
+
+python -m doctest reader.py
+
+python -m doctest peephole.py
+
+python -m doctest compilecache.py
+
+python -m doctest session.py
+
+python -m doctest profiler.py
@@ -14,7 +14,15 @@ try:
 except:
     pass
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import re
 import sys
+from array import array
+from collections import OrderedDict
 
 # We have a fixed amount of memory available.
 MAX_ADDRESS = 1000
@@ -27,6 +35,46 @@ MAX_ADDRESS = 1000
 TAG_INTEGER     = 'INT'
 TAG_NONTERMINAL = 'NT'
 
+# A lazy cell is of the form (TAG_LAZY, it) where it is a Python iterator. It
+# stands for the list of the items that it has yet to produce, and is replaced
+# by an ordinary nonterminal cell the first time that its car or cdr is needed.
+TAG_LAZY        = 'LAZY'
+
+# A vector cell is of the form (TAG_VECTOR, v) where v is a contiguous array of
+# integers: a numpy array if numpy is available, otherwise an array.array.
+TAG_VECTOR      = 'VEC'
+
+# Elements of a vector, and the results of VADD and VSUM, are 64 bit integers.
+# Going outside this range fails an assertion with either backend.
+VECTOR_MIN = -2**63
+VECTOR_MAX =  2**63 - 1
+
+# A frame cell is of the form (TAG_FRAME, args) where args is a Python list of
+# the addresses of a function's arguments. AP1, AP2 and APN make one for each
+# call instead of consing an argument list; locate() reads it directly.
+TAG_FRAME       = 'FRAME'
+
+# A closure cell is of the form (TAG_CLOSURE, code, env), the code and the
+# environment of a function, as made by LDF. get_value() shows it as the list
+# [code, env].
+TAG_CLOSURE     = 'CLOSURE'
+
+# A dump cell is of the form (TAG_DUMP, s, e, c, next): the S, E and C saved
+# by a function application, and the rest of the dump. Nothing but the D
+# register refers to these cells, so RTN puts them on a free list for the
+# next application to reuse; get_value() shows the dump as [c, e, s, ...].
+TAG_DUMP        = 'DUMP'
+
+# Buffered output is written to the output stream in blocks of this many bytes.
+OUTPUT_FLUSH_SIZE = 65536
+
+# An integer in the pre-filled input buffer (see SECD.set_input()).
+INPUT_INT_RE = re.compile(r'\s*(-?\d+)')
+
+# Memoised closure application (see SECD.enable_memo()). Arguments or results
+# with more than MEMO_MAX_NODES cells are not memoised.
+MEMO_MAX_NODES = 100
+
 # Opcodes are stored in memory as strings. This is cheating (really we should have
 # a bijection ADD <-> 100, MUL <-> 101, etc) but it simplifies debugging.
 
@@ -53,6 +101,7 @@ RTN     = 'RTN'
 SEL     = 'SEL'
 STOP    = 'STOP'
 SUB     = 'SUB'
+WRITEB  = 'WRITEB'
 WRITEC  = 'WRITEC'
 WRITEI  = 'WRITEI'
 
@@ -60,6 +109,35 @@ ZEROP   = 'ZEROP'
 GT0P    = 'GT0P'
 LT0P    = 'LT0P'
 
+LENGTH  = 'LENGTH'
+APPEND  = 'APPEND'
+REVERSE = 'REVERSE'
+NTH     = 'NTH'
+EQUAL   = 'EQUAL'
+
+VEC     = 'VEC'
+VREF    = 'VREF'
+VSET    = 'VSET'
+VLEN    = 'VLEN'
+VADD    = 'VADD'
+VSUM    = 'VSUM'
+
+BRZ     = 'BRZ'
+BRGT0   = 'BRGT0'
+BRLT0   = 'BRLT0'
+BRNULL  = 'BRNULL'
+
+AP1     = 'AP1'
+AP2     = 'AP2'
+APN     = 'APN'
+
+EQ      = 'EQ'
+LT      = 'LT'
+LE      = 'LE'
+GT      = 'GT'
+GE      = 'GE'
+MOD     = 'MOD'
+
 OP_CODES = [ADD,      # integer addition
             MUL,      # integer multiplication
             SUB,      # integer subtraction
@@ -84,6 +162,7 @@ OP_CODES = [ADD,      # integer addition
 
             WRITEI,   # write an integer to the terminal
             WRITEC,   # write a character to the terminal, e.g. 96 -> 'a'
+            WRITEB,   # write a single byte to the terminal, with no newline                        [nonstandard opcode]
 
             READC,    # read a single character from the terminal
             READI,    # read an integer from the terminal
@@ -94,21 +173,71 @@ OP_CODES = [ADD,      # integer addition
             GT0P,     # test if top of stack is greater than zero (does not consume the element)    [nonstandard opcode]
             LT0P,     # test if top of stack is less    than zero (does not consume the element)    [nonstandard opcode]
 
+            LENGTH,   # length of a list                                                            [nonstandard opcode]
+            APPEND,   # append two lists (copies the first)                                         [nonstandard opcode]
+            REVERSE,  # reverse a list                                                              [nonstandard opcode]
+            NTH,      # n-th element of a list, counting from zero                                  [nonstandard opcode]
+            EQUAL,    # structural equality of two values                                           [nonstandard opcode]
+
+            VEC,      # make an integer vector from a length or a list of integers                  [nonstandard opcode]
+            VREF,     # i-th element of a vector                                                    [nonstandard opcode]
+            VSET,     # set the i-th element of a vector, in place                                  [nonstandard opcode]
+            VLEN,     # length of a vector                                                          [nonstandard opcode]
+            VADD,     # elementwise sum of two vectors                                              [nonstandard opcode]
+            VSUM,     # sum of the elements of a vector                                             [nonstandard opcode]
+
+            BRZ,      # pop an integer and branch like SEL on (x == 0)                              [nonstandard opcode]
+            BRGT0,    # pop an integer and branch like SEL on (x > 0)                               [nonstandard opcode]
+            BRLT0,    # pop an integer and branch like SEL on (x < 0)                               [nonstandard opcode]
+            BRNULL,   # pop a list and branch like SEL on (x == nil)                                [nonstandard opcode]
+
+            AP1,      # apply a function to the one argument under it on the stack                 [nonstandard opcode]
+            AP2,      # apply a function to the two arguments under it on the stack                [nonstandard opcode]
+            APN,      # apply a function to the k arguments under it on the stack; k follows APN   [nonstandard opcode]
+
+            EQ,       # pop x and y and test x == y                                                 [nonstandard opcode]
+            LT,       # pop x and y and test x <  y                                                 [nonstandard opcode]
+            LE,       # pop x and y and test x <= y                                                 [nonstandard opcode]
+            GT,       # pop x and y and test x >  y                                                 [nonstandard opcode]
+            GE,       # pop x and y and test x >= y                                                 [nonstandard opcode]
+            MOD,      # integer remainder, with the sign of the divisor (DIV rounds down)           [nonstandard opcode]
+
            ]
 OP_CODES = dict([(op, True) for op in OP_CODES])
 
+# The tests made by the comparison opcodes, on the top x and next y of the stack.
+COMPARISONS = {EQ: lambda x, y: x == y,
+               LT: lambda x, y: x <  y,
+               LE: lambda x, y: x <= y,
+               GT: lambda x, y: x >  y,
+               GE: lambda x, y: x >= y}
+
+# Opcodes with side effects, or that read a vector, which VSET may change in
+# place. A closure that runs one of these is never memoised.
+IMPURE_OP_CODES = dict([(op, True) for op in [WRITEI, WRITEC, WRITEB, READC, READI,
+                                              VSET, VREF, VLEN, VADD, VSUM]])
+
 
 class SECD:
-    def __init__(self):
+    def __init__(self, max_address=MAX_ADDRESS):
         # Memory of the machine. A 'None' indicates an unused cell. Note that
         # 0 is never used because that corresponds to nil.
-        self.memory = [None] + [None]*MAX_ADDRESS
+        self.max_address = max_address
+        self.memory = [None] + [None]*max_address
         self.max_used_address = 1
 
         # By default WRITEI and WRITEC write to stdout.
         self.output_stream = sys.stdout
         self.input_stream  = sys.stdin
 
+        # STOP writes its banner here; set to None for silence.
+        self.halt_stream   = sys.stdout
+
+        # Optional I/O buffers, see set_input() and buffer_output().
+        self.input_buffer  = None
+        self.input_pos     = 0
+        self.output_buffer = None
+
         self.debug = False
 
         # Registers:
@@ -129,7 +258,32 @@ class SECD:
         self.registers['D'] = self.get_new_address()
         self.set_nonterminal(self.registers['D'], 0, 0)
 
-        assert self.max_used_address < MAX_ADDRESS
+        # Dump cells popped by RTN, free to be used again by push_dump().
+        self.dump_free = []
+
+        # Return points saved by SEL for JOIN. These are strictly LIFO and
+        # never captured by a closure, so unlike the dump they are kept in
+        # a Python list and cost no memory cells.
+        self.join_stack = []
+
+        assert self.max_used_address < self.max_address
+
+        # Memo table for closure application; off unless enable_memo() is called.
+        self.memo = None
+        self.memo_hits   = 0
+        self.memo_misses = 0
+
+        # The cells holding 0 and 1 that comparisons push, made when first
+        # needed; see boolean().
+        self.boolean_cells = {}
+
+        # Closures that to_python() is converting, to cut the cycles made
+        # by DUM/RAP.
+        self.closures_in_to_python = {}
+
+        # Address of a code cell -> (function, e), the source that
+        # compiler.compile() gave for it; see load_program().
+        self.source = {}
 
     def dump_registers(self):
         """
@@ -201,13 +355,15 @@ class SECD:
         """
 
         self.max_used_address += 1
-        assert self.max_used_address < MAX_ADDRESS, 'Error, out of memory.'
+        assert self.max_used_address < self.max_address, 'Error, out of memory.'
         return self.max_used_address
 
     def tag(self, address):
         """
         All memory cells have a tag, indicating if the cell stores
-        an integers (TAG_INTEGER) or nonterminal (TAG_NONTERMINAL).
+        an integers (TAG_INTEGER), nonterminal (TAG_NONTERMINAL),
+        integer vector (TAG_VECTOR), environment frame (TAG_FRAME),
+        closure (TAG_CLOSURE) or dump frame (TAG_DUMP).
 
         >>> m = SECD()
 
@@ -295,6 +451,9 @@ class SECD:
         123
         """
 
+        if self.memory[address][0] == TAG_LAZY:
+            self.force(address)
+
         assert self.memory[address][0] == TAG_NONTERMINAL
         return self.memory[address][1]
 
@@ -326,6 +485,9 @@ class SECD:
         123
         """
 
+        if self.memory[address][0] == TAG_LAZY:
+            self.force(address)
+
         assert self.memory[address][0] == TAG_NONTERMINAL
         return self.memory[address][2]
 
@@ -373,6 +535,164 @@ class SECD:
 
         self.memory[address] = (TAG_NONTERMINAL, car_value, cdr_value)
 
+    def store_lazy_list(self, address, iterable):
+        """
+        Store 'iterable' at 'address' as a lazy list. Nothing is read
+        from it until the program takes the car or cdr of the list (or
+        tests it with NULL), and then only one item at a time, so the
+        input is never held in memory as a Python list and items past
+        the point the program has reached are never read. Items must
+        be integers or Python lists.
+
+        This is not constant-memory streaming. The machine has no
+        garbage collector, so each item that is read stays in its
+        cells even after the program has moved past it. Walking a
+        stream of n items uses O(n) cells, and the same limit on
+        memory applies as for store_py_list().
+
+        >>> import itertools
+        >>> s = SECD()
+        >>> naturals = s.get_new_address()
+        >>> s.store_lazy_list(naturals, itertools.count())
+        >>> s.load_program([NTH], [])
+        >>> s.push_stack('S', naturals)
+        >>> three = s.get_new_address()
+        >>> s.set_int(three, 3)
+        >>> s.push_stack('S', three)
+        >>> s.execute_opcode()
+        >>> s.get_value(s.registers['S'])
+        [3]
+
+        Only the first four items have been read:
+
+        >>> s.get_value(naturals)
+        [0, 1, 2, 3, '...']
+
+        A file can be read one line at a time with, for example,
+        s.store_lazy_list(address, (int(line) for line in open(path))).
+        """
+
+        self.memory[address] = (TAG_LAZY, iter(iterable))
+
+    def force(self, address):
+        """
+        If the cell at 'address' is lazy, read the next item from its
+        iterator and replace the cell by a nonterminal whose car is
+        the item and whose cdr is a new lazy cell, or by nil if the
+        iterator is exhausted.
+        """
+
+        cell = self.memory[address]
+        if cell[0] != TAG_LAZY:
+            return
+
+        try:
+            x = next(cell[1])
+        except StopIteration:
+            self.set_nonterminal(address, 0, 0)
+            return
+
+        car_address = self.get_new_address()
+        cdr_address = self.get_new_address()
+
+        if type(x) == list:
+            self.store_py_list(car_address, x)
+        else:
+            self.set_int(car_address, x)
+        self.memory[cdr_address] = (TAG_LAZY, cell[1])
+
+        self.set_nonterminal(address, car_address, cdr_address)
+
+    def push_dump(self, s, e, c):
+        """
+        Save the registers s, e and c on the dump, in one cell. A cell
+        from the free list is used if there is one.
+
+        >>> m = SECD()
+        >>> m.push_dump(10, 20, 30)
+        >>> m.registers['D'], m.memory[m.registers['D']]
+        (5, ('DUMP', 10, 20, 30, 4))
+        >>> m.pop_dump()
+        (10, 20, 30)
+        >>> m.push_dump(11, 21, 31)
+        >>> m.registers['D'], m.max_used_address
+        (5, 5)
+        """
+
+        if self.dump_free:
+            address = self.dump_free.pop()
+        else:
+            address = self.get_new_address()
+        self.memory[address] = (TAG_DUMP, s, e, c, self.registers['D'])
+        self.registers['D'] = address
+
+    def pop_dump(self):
+        """
+        Pop the top of the dump, returning the saved (s, e, c).
+        """
+
+        address = self.registers['D']
+        cell = self.memory[address]
+        assert cell[0] == TAG_DUMP
+
+        self.registers['D'] = cell[4]
+        self.dump_free.append(address)
+        return cell[1], cell[2], cell[3]
+
+    def set_closure(self, address, code, env):
+        """
+        Set a closure cell, holding the addresses of a function's code
+        and of its environment.
+
+        >>> m = SECD()
+        >>> new_cell = m.get_new_address()
+        >>> m.set_closure(new_cell, 100, 200)
+        >>> m.memory[new_cell]
+        ('CLOSURE', 100, 200)
+        >>> m.get_closure(new_cell)
+        (100, 200)
+        """
+
+        self.memory[address] = (TAG_CLOSURE, code, env)
+
+    def get_closure(self, address):
+        """
+        Get the code and environment addresses of a closure cell.
+        """
+
+        cell = self.memory[address]
+        assert cell[0] == TAG_CLOSURE
+        return cell[1], cell[2]
+
+    def store_vector(self, address, x):
+        """
+        Store the integers in x as a single vector cell. This is the
+        bulk alternative to store_py_list() for numeric data.
+
+        >>> m = SECD()
+        >>> new_cell = m.get_new_address()
+        >>> m.store_vector(new_cell, range(5))
+        >>> m.tag(new_cell)
+        'VEC'
+        >>> m.get_value(new_cell)
+        [0, 1, 2, 3, 4]
+        """
+
+        if numpy is not None:
+            v = numpy.array(x, dtype=numpy.int64)
+        else:
+            v = array('l', x)
+
+        self.memory[address] = (TAG_VECTOR, v)
+
+    def get_vector(self, address):
+        """
+        Get the array stored in a vector cell.
+        """
+
+        assert self.memory[address][0] == TAG_VECTOR
+        return self.memory[address][1]
+
     def store_py_list(self, address, x):
         """
         Given the Python list x, store it in the machine's memory
@@ -436,6 +756,9 @@ class SECD:
         'address'. We will either return an integer or a list. For
         examples see store_py_list().
 
+        A vector is returned as a list of its elements. The unread
+        part of a lazy list is shown as '...'.
+
         Note: this function is not the inverse of store_py_list()
         due to the possible existence of cycles as created by the
         DUM/RAP opcodes (note the case where '*** RECURSIVE LOOP ***'
@@ -462,13 +785,28 @@ class SECD:
 
     def _get_value(self, address):
 
+        # Integers, vectors and lazy lists point to no other cell, so
+        # they cannot be part of a loop; a shared one is just shared.
+        if self.tag(address) == TAG_INTEGER:
+            return self.get_int(address)
+        elif self.tag(address) == TAG_VECTOR:
+            return [int(x) for x in self.get_vector(address)]
+        elif self.tag(address) == TAG_LAZY:
+            # Don't read from the iterator just to print the list.
+            return ['...']
+
         if address in self.seen_by_get_value:
             return ['*** RECURSIVE LOOP ***']
 
         self.seen_by_get_value[address] = True
 
-        if self.tag(address) == TAG_INTEGER:
-            return self.get_int(address)
+        if self.tag(address) == TAG_FRAME:
+            return [self._get_value(a) for a in self.memory[address][1]]
+        elif self.tag(address) == TAG_CLOSURE:
+            return [self._get_value(a) for a in self.get_closure(address)]
+        elif self.tag(address) == TAG_DUMP:
+            _, s, e, c, rest = self.memory[address]
+            return [self._get_value(c), self._get_value(e), self._get_value(s)] + self._get_value(rest)
         elif self.tag(address) == TAG_NONTERMINAL:
             if self.car(address) == 0 and self.cdr(address) == 0:
                 return []
@@ -482,6 +820,147 @@ class SECD:
         else:
             assert False, 'Unknown tag: %s' % self.tag(address)
 
+    def to_python(self, address):
+        """
+        Return a Python object representing the data stored at
+        'address', like get_value(), but without recursion, so it
+        copes with long and deeply nested lists. A cycle (as made by
+        DUM/RAP) is cut with the same '*** RECURSIVE LOOP ***' marker,
+        but unlike get_value() a sublist that is merely shared is
+        converted each time it appears.
+
+        >>> m = SECD()
+        >>> new_cell = m.get_new_address()
+        >>> m.store_py_list(new_cell, [[1, 2], [3], [[[4]]], 5])
+        >>> m.to_python(new_cell)
+        [[1, 2], [3], [[[4]]], 5]
+
+        >>> m.set_int(new_cell, 33)
+        >>> m.to_python(new_cell)
+        33
+
+        A closure is shown as its code and its environment:
+
+        >>> m.load_program([LDF, [LD, [1, 1], RTN], STOP])
+        >>> m.execute_opcode()
+        >>> m.to_python(m.car(m.registers['S']))
+        [['LD', [1, 1], 'RTN'], []]
+        """
+
+        def atom(address):
+            cell = self.memory[address]
+            if cell[0] == TAG_INTEGER:
+                return cell[1]
+            elif cell[0] == TAG_VECTOR:
+                return [int(x) for x in cell[1]]
+            elif cell[0] == TAG_LAZY:
+                return '...'
+            elif cell[0] == TAG_FRAME:
+                return [self.to_python(a) for a in cell[1]]
+            elif cell[0] == TAG_CLOSURE:
+                if address in self.closures_in_to_python:
+                    return '*** RECURSIVE LOOP ***'
+                self.closures_in_to_python[address] = True
+                try:
+                    return [self.to_python(cell[1]), self.to_python(cell[2])]
+                finally:
+                    del self.closures_in_to_python[address]
+            return None
+
+        cell = self.memory[address]
+        if cell[0] != TAG_NONTERMINAL:
+            return atom(address)
+
+        # Each entry is [items so far, rest of the list, spine cells visited];
+        # on_path holds the spine cells of every list being converted.
+        on_path = {}
+        stack = [[[], address, []]]
+
+        while True:
+            items, rest, spine = stack[-1]
+            cell = self.memory[rest]
+
+            if rest in on_path:
+                items.append('*** RECURSIVE LOOP ***')
+                cell = (TAG_NONTERMINAL, 0, 0)
+            elif cell[0] == TAG_LAZY:
+                items.append('...')
+                cell = (TAG_NONTERMINAL, 0, 0)
+
+            if cell[1] == 0 and cell[2] == 0:
+                stack.pop()
+                for a in spine:
+                    del on_path[a]
+                if not stack:
+                    return items
+                stack[-1][0].append(items)
+                continue
+
+            on_path[rest] = True
+            spine.append(rest)
+            stack[-1][1] = cell[2]
+
+            if cell[1] == 0:
+                # Special case constructed by DUM.
+                items.append('NIL_PTR0')
+                continue
+
+            head = self.memory[cell[1]]
+            if head[0] == TAG_NONTERMINAL:
+                stack.append([[], cell[1], []])
+            else:
+                items.append(atom(cell[1]))
+
+    def run(self):
+        """
+        Execute opcodes until the machine halts and return the value
+        on the top of the stack, converted by to_python(), or None if
+        the stack is empty. Set halt_stream to None to suppress the
+        'MACHINE HALTED!' banner.
+
+        >>> s = SECD()
+        >>> s.halt_stream = None
+        >>> s.load_program([LDC, 3, ADD, STOP], [4, 500])
+        >>> s.run()
+        7
+
+        >>> s.load_program([LDC, [1, [2, 3]], STOP])
+        >>> s.run()
+        [1, [2, 3]]
+
+        Buffered output is flushed even if the run fails:
+
+        >>> from StringIO import StringIO
+        >>> s.output_stream = StringIO()
+        >>> s.buffer_output()
+        >>> s.load_program([WRITEI, CAR, STOP], [42, 7])
+        >>> s.run()
+        Traceback (most recent call last):
+        ...
+        AssertionError
+        >>> s.output_stream.getvalue()
+        '42\\n'
+        """
+
+        try:
+            while self.running:
+                self.execute_opcode()
+        finally:
+            self.flush_output()
+
+        return self.result()
+
+    def result(self):
+        """
+        The value on the top of the stack, converted by to_python(), or
+        None if the stack is empty.
+        """
+
+        top = self.registers['S']
+        if self.memory[top][1] == 0:
+            return None
+        return self.to_python(self.car(top))
+
     def graph_at_address(self, address):
         """
         Produce a dotty (graphviz) graph representing the linked structure at
@@ -531,6 +1010,42 @@ class SECD:
             graph.add_node(pydot.Node(name='node' + str(address),
                                       label=pydot_record_string([str(address), str(self.get_int(address))]),
                                       shape='record'))
+        elif self.tag(address) == TAG_LAZY:
+            graph.add_node(pydot.Node(name='node' + str(address),
+                                      label=pydot_record_string([str(address), 'lazy']),
+                                      shape='record'))
+        elif self.tag(address) == TAG_VECTOR:
+            graph.add_node(pydot.Node(name='node' + str(address),
+                                      label=pydot_record_string([str(address), 'vec'] +
+                                                                [str(x) for x in self.get_vector(address)]),
+                                      shape='record'))
+        elif self.tag(address) == TAG_FRAME:
+            args = self.memory[address][1]
+            graph.add_node(pydot.Node(name='node' + str(address),
+                                      label=pydot_record_string([str(address), 'frame'] + ['arg %d' % a for a in args]),
+                                      shape='record'))
+            for (k, a) in enumerate(args):
+                graph.add_edge(pydot.Edge('node%d:f%d' % (address, k + 2), 'node%d:f0' % a))
+                self._graph_at_address(a, graph)
+        elif self.tag(address) == TAG_CLOSURE:
+            code, env = self.get_closure(address)
+            graph.add_node(pydot.Node(name='node' + str(address),
+                                      label=pydot_record_string([str(address), 'closure',
+                                                                 'code %d' % code, 'env %d' % env]),
+                                      shape='record'))
+            graph.add_edge(pydot.Edge('node%d:f2' % address, 'node%d:f0' % code))
+            graph.add_edge(pydot.Edge('node%d:f3' % address, 'node%d:f0' % env))
+            self._graph_at_address(code, graph)
+            self._graph_at_address(env, graph)
+        elif self.tag(address) == TAG_DUMP:
+            fields = zip(['s', 'e', 'c', 'next'], self.memory[address][1:])
+            graph.add_node(pydot.Node(name='node' + str(address),
+                                      label=pydot_record_string([str(address), 'dump'] +
+                                                                ['%s %d' % f for f in fields]),
+                                      shape='record'))
+            for (k, (_, a)) in enumerate(fields):
+                graph.add_edge(pydot.Edge('node%d:f%d' % (address, k + 2), 'node%d:f0' % a))
+                self._graph_at_address(a, graph)
         elif self.tag(address) == TAG_NONTERMINAL:
             if self.car(address) == 0 and self.cdr(address) == 0:
                 graph.add_node(pydot.Node(name='node' + str(address),
@@ -560,7 +1075,7 @@ class SECD:
         else:
             assert False, 'Unknown tag: %s' % self.tag(address)
 
-    def load_program(self, code, stack=[]):
+    def load_program(self, code, stack=[], source_map=None):
         """
         Initialise the C register with 'code' and the stack S with 'stack'.
 
@@ -570,15 +1085,323 @@ class SECD:
         ['ADD']
         >>> s.get_value(s.registers['S'])
         [100, 42]
+
+        If 'source_map' is given, from compiler.compile(), the sources
+        it gives for positions in 'code' are added to self.source under
+        the addresses of the cells that hold those instructions. So the
+        source of the instruction that C points to is self.source[C]:
+
+        >>> s = SECD()
+        >>> s.halt_stream = None
+        >>> code = [LDC, 2, LDF, [LD, [1, 1], CAR, RTN], AP1, STOP]
+        >>> source_map = {(0,): (None, 2), (2,): (None, 'f'), (4,): (None, ['f', 2]),
+        ...               (3, 0): ('f', 'x'), (3, 2): ('f', ['CAR', 'x'])}
+        >>> s.load_program(code, [], source_map)
+        >>> s.source[s.registers['C']]
+        (None, 2)
+        >>> for _ in range(4): s.execute_opcode()
+        >>> s.source[s.registers['C']]
+        ('f', ['CAR', 'x'])
+
+        An assertion that fails in an instruction with a source says
+        where the instruction came from:
+
+        >>> s.execute_opcode()
+        Traceback (most recent call last):
+        ...
+        AssertionError: in f, at ['CAR', 'x']
         """
 
         program = self.get_new_address()
         self.store_py_list(program, code)
         self.registers['C'] = program
 
+        if source_map is not None:
+            self.load_source_map(program, source_map)
+
         self.store_py_list(self.registers['S'], stack)
         self.running = True
 
+    def load_source_map(self, program, source_map):
+        """
+        Add to self.source the address of each cell of the code at
+        'program' that source_map has a source for. Positions in
+        source_map are tuples of indices, into 'program' and the code
+        lists nested in it; see compiler.compile_into().
+        """
+
+        work = [((), program)] # (position, address) of code lists to visit
+        while work:
+            path, address = work.pop()
+            i = 0
+            while self.memory[address] != (TAG_NONTERMINAL, 0, 0):
+                position = path + (i,)
+                if position in source_map:
+                    self.source[address] = source_map[position]
+
+                car = self.car(address)
+                if self.memory[car][0] == TAG_NONTERMINAL:
+                    work.append((position, car))
+
+                address = self.cdr(address)
+                i += 1
+
+    def enable_memo(self, max_size=1000):
+        """
+        Memoise closure application. Before AP runs a closure we look
+        up (code address, environment address, argument list) in an
+        LRU table of at most 'max_size' entries; on a hit the saved
+        result is pushed and the call is skipped. On a miss the result
+        is recorded by the matching RTN. Call this before running a
+        program.
+
+        Closures whose code contains WRITEI, WRITEC, READI, READC or a
+        vector opcode are never memoised; a vector may change under
+        VSET between calls. Neither is any call that is still running
+        when one of those opcodes executes (for example because it
+        called an impure function), and its code is remembered as
+        impure. RAP is
+        never memoised because its argument list is cyclic.
+
+        Naive Fibonacci makes 1973 calls to compute fib(15); with the
+        memo table only 16 of them run:
+
+        >>> from compiler import compile, LET, LETREC, LAMBDA, IF
+        >>> fib = [LAMBDA, ['n'], [IF, [GT0P, [SUB, 'n', 1]],
+        ...                           [ADD, ['fib', [SUB, 'n', 1]], ['fib', [SUB, 'n', 2]]],
+        ...                           'n']]
+        >>> code = compile([LETREC, ['fib'], [fib], ['fib', 15]], [], [WRITEI, STOP])
+        >>> s = SECD()
+        >>> s.enable_memo()
+        >>> s.load_program(code)
+        >>> while s.running: s.execute_opcode()
+        610
+        <BLANKLINE>
+        MACHINE HALTED!
+        <BLANKLINE>
+        >>> s.memo_hits, s.memo_misses
+        (13, 16)
+        >>> s.memo.values()[:5]
+        [0, 1, 1, 2, 3]
+
+        Here f writes its argument before returning it, so both calls
+        to f run. The function that calls f is pure on its own and so
+        counts as a miss, but it is not recorded because it called f.
+        The outermost call is not even looked up, since its argument is
+        a closure:
+
+        >>> f    = [LD, [1, 1], WRITEI, LD, [1, 1], RTN]
+        >>> body = [NIL, LDC, 1, CONS, LD, [2, 1], AP, NIL, LDC, 1, CONS, LD, [2, 1], AP, ADD, RTN]
+        >>> s = SECD()
+        >>> s.enable_memo()
+        >>> s.load_program([NIL, LDF, f, CONS, LDF, [NIL, LDC, 0, CONS, LDF, body, AP, RTN], AP, WRITEI, STOP])
+        >>> while s.running: s.execute_opcode()
+        1
+        1
+        2
+        <BLANKLINE>
+        MACHINE HALTED!
+        <BLANKLINE>
+        >>> s.memo_hits, s.memo_misses, len(s.memo)
+        (0, 1, 0)
+
+        A function that reads a vector sees the element set between its
+        two calls:
+
+        >>> e = [LET, ['v'], [[VEC, 3]],
+        ...      [LET, ['f'], [[LAMBDA, ['i'], [VREF, 'v', 'i']]],
+        ...       [ADD, ['f', 0], [ADD, [VREF, [VSET, 'v', 0, 7], 0], ['f', 0]]]]]
+        >>> s = SECD()
+        >>> s.enable_memo()
+        >>> s.load_program(compile(e, [], [WRITEI, STOP]))
+        >>> while s.running: s.execute_opcode()
+        14
+        <BLANKLINE>
+        MACHINE HALTED!
+        <BLANKLINE>
+        """
+
+        self.memo = OrderedDict()
+        self.memo_max_size = max_size
+        self.memo_hits   = 0
+        self.memo_misses = 0
+
+        # Purity of closure code, by code address:
+        self.memo_pure = {}
+
+        # One entry per AP/RAP frame on the dump: the memo key of the
+        # call, or None if its result will not be recorded.
+        self.memo_frames = []
+
+    def memo_lookup(self, args, rest, after):
+        """
+        Called by AP and APx when memoisation is on, with the closure
+        on top of the stack. 'args' is the address of the argument
+        list (AP) or a list of the arguments' addresses (APx), 'rest'
+        is the stack under the arguments and 'after' the code after
+        the call. Returns True if the application was answered from
+        the memo table, in which case the result is on the stack and C
+        is 'after'.
+        """
+
+        code, env = self.get_closure(self.car(self.registers['S']))
+
+        key = None
+        if self.memo_is_pure(code):
+            if type(args) == list:
+                frozen = tuple(self.memo_freeze(a) for a in args)
+                if None in frozen:
+                    frozen = None
+            else:
+                frozen = self.memo_freeze(args)
+            if frozen is not None:
+                key = (code, env, frozen)
+
+        if key is not None and key in self.memo:
+            # Move the entry to the most recently used end:
+            value = self.memo.pop(key)
+            self.memo[key] = value
+            self.memo_hits += 1
+
+            self.registers['S'] = rest
+            self.push_stack('S', self.memo_thaw(value))
+            self.registers['C'] = after
+            return True
+
+        if key is not None:
+            self.memo_misses += 1
+        self.memo_frames.append(key)
+        return False
+
+    def memo_store(self, key, result):
+        """
+        Record the result of a memoised call, evicting the least
+        recently used entry if the table is full.
+        """
+
+        if key is None:
+            return
+
+        value = self.memo_freeze(result)
+        if value is None:
+            return
+
+        self.memo[key] = value
+        while len(self.memo) > self.memo_max_size:
+            self.memo.popitem(last=False)
+
+    def memo_taint(self):
+        """
+        Called when an impure opcode runs: none of the calls in
+        progress may be memoised, now or later.
+        """
+
+        for key in self.memo_frames:
+            if key is not None:
+                self.memo_pure[key[0]] = False
+        self.memo_frames = [None]*len(self.memo_frames)
+
+    def memo_is_pure(self, code):
+        """
+        Scan the code of a closure, including nested function bodies,
+        for impure opcodes. Results are cached by code address.
+        """
+
+        if code not in self.memo_pure:
+            pure = True
+            seen = {}
+            stack = [code]
+
+            while stack and pure:
+                address = stack.pop()
+                if address == 0 or address in seen:
+                    continue
+                seen[address] = True
+
+                cell = self.memory[address]
+                if cell[0] == TAG_INTEGER:
+                    pure = cell[1] not in IMPURE_OP_CODES
+                elif cell[0] == TAG_NONTERMINAL:
+                    stack.append(cell[1])
+                    stack.append(cell[2])
+
+            self.memo_pure[code] = pure
+
+        return self.memo_pure[code]
+
+    def memo_freeze(self, address):
+        """
+        Convert the structure at 'address' to an integer or nested
+        tuples, for use in the memo table. Returns None if the
+        structure is cyclic, contains the nil pointer made by DUM or a
+        closure, or has more than MEMO_MAX_NODES cells.
+
+        >>> s = SECD()
+        >>> a = s.get_new_address()
+        >>> s.store_py_list(a, [1, [2, []], 3])
+        >>> s.memo_freeze(a)
+        (1, (2, ()), 3)
+        """
+
+        cell = self.memory[address]
+        if cell[0] == TAG_INTEGER:
+            return cell[1]
+
+        nodes = 0
+        seen  = {}
+
+        # Each entry is [items so far, address of the rest of the list].
+        stack = [[[], address]]
+
+        while True:
+            items, rest = stack[-1]
+            cell = self.memory[rest]
+
+            if cell[0] != TAG_NONTERMINAL:
+                return None
+
+            if cell[1] == 0:
+                if cell[2] != 0:
+                    return None
+
+                stack.pop()
+                value = tuple(items)
+                if not stack:
+                    return value
+                stack[-1][0].append(value)
+                continue
+
+            nodes += 1
+            if nodes > MEMO_MAX_NODES or rest in seen:
+                return None
+            seen[rest] = True
+
+            stack[-1][1] = cell[2]
+
+            head = self.memory[cell[1]]
+            if head[0] == TAG_INTEGER:
+                items.append(head[1])
+            else:
+                stack.append([[], cell[1]])
+
+    def memo_thaw(self, value):
+        """
+        Store a value produced by memo_freeze() in fresh cells and
+        return its address.
+        """
+
+        def as_list(x):
+            if type(x) == tuple:
+                return [as_list(y) for y in x]
+            return x
+
+        address = self.get_new_address()
+        if type(value) == tuple:
+            self.store_py_list(address, as_list(value))
+        else:
+            self.set_int(address, value)
+        return address
+
     def opcode_ADD(self):
         """
         Integer addition; arguments are taken from the stack.
@@ -691,47 +1514,191 @@ class SECD:
 
         self.registers['C'] = self.cdr(self.registers['C'])
 
-    def opcode_NIL(self):
+    def opcode_MOD(self):
         """
-        Push an empty list (nil) onto the stack. See also CONS.
+        Integer remainder; arguments are taken from the stack. The
+        result has the sign of the divisor, to agree with DIV, which
+        rounds down.
 
         >>> s = SECD()
-        >>> s.load_program([NIL], [18, 19])
-        >>> s.get_value(s.registers['S'])
-        [18, 19]
+        >>> s.load_program([MOD], [-7, 3])
         >>> s.execute_opcode()
-        >>> s.dump_registers()
-        S: address = 13 value: [[], 18, 19]
-        E: address = 3 value: []
-        C: address = 7 value: 7
-        D: address = 4 value: []
+        >>> s.get_value(s.registers['S'])
+        [2]
         """
 
-        assert self.get_int(self.car(self.registers['C'])) == NIL
+        assert self.get_int(self.car(self.registers['C'])) == MOD
 
-        new_cell = self.get_new_address()
-        self.set_nonterminal(new_cell, 0, 0)
-        self.push_stack('S', new_cell)
+        val1 = self.get_int(self.car(self.registers['S']))
+        self.pop_stack('S')
+
+        val2 = self.get_int(self.car(self.registers['S']))
+        self.pop_stack('S')
+
+        result = self.get_new_address()
+        self.set_int(result, val1 % val2)
+        self.push_stack('S', result)
 
         self.registers['C'] = self.cdr(self.registers['C'])
 
-    def opcode_LDC(self):
+    def boolean(self, x):
         """
-        Load a constant onto the stack. The constant expression
-        is whatever follows LDC in C, so it may be an arbitrary
-        s-expression.
+        The address of a cell holding 1 if x is true and 0 otherwise.
+        There is one such cell for each value, shared by every result
+        of a comparison, since integer cells are never changed in
+        place. get_value() does not mistake a shared integer for a
+        loop:
 
-        >>> s = SECD()
-        >>> s.load_program([LDC, 3], [18, 19])
-        >>> s.execute_opcode()
-        >>> s.dump_registers()
-        S: address = 14 value: [3, 18, 19]
-        E: address = 3 value: []
-        C: address = 9 value: 9
-        D: address = 4 value: []
+        >>> m = SECD()
+        >>> m.boolean(3 < 4) == m.boolean(True), m.get_int(m.boolean(False))
+        (True, 0)
+        >>> m.load_program([LDC, 4, LDC, 3, LT, LDC, 2, LDC, 1, LT, STOP])
+        >>> for _ in range(6): m.execute_opcode()
+        >>> m.get_value(m.registers['S'])
+        [1, 1]
+        """
 
-        >>> s = SECD()
-        >>> s.load_program([LDC, [3, 4, [18]]], [1])
+        x = int(bool(x))
+        if x not in self.boolean_cells:
+            address = self.get_new_address()
+            self.set_int(address, x)
+            self.boolean_cells[x] = address
+        return self.boolean_cells[x]
+
+    def compare(self, op):
+        """
+        Shared part of EQ, LT, LE, GT and GE. Pops two integers and
+        pushes the result of the test COMPARISONS[op]. Unlike ZEROP and
+        friends the operands are consumed, and the only cell allocated
+        is the one that links the result onto the stack.
+        """
+
+        assert self.get_int(self.car(self.registers['C'])) == op
+
+        x = self.get_int(self.car(self.registers['S']))
+        self.pop_stack('S')
+
+        y = self.get_int(self.car(self.registers['S']))
+        self.pop_stack('S')
+
+        self.push_stack('S', self.boolean(COMPARISONS[op](x, y)))
+
+        self.registers['C'] = self.cdr(self.registers['C'])
+
+    def opcode_EQ(self):
+        """
+        Test if the top two integers on the stack are equal.
+
+        >>> s = SECD()
+        >>> s.load_program([EQ, EQ], [4, 4, 0])
+        >>> s.execute_opcode()
+        >>> s.get_value(s.registers['S'])
+        [1, 0]
+        >>> s.execute_opcode()
+        >>> s.get_value(s.registers['S'])
+        [0]
+        """
+
+        self.compare(EQ)
+
+    def opcode_LT(self):
+        """
+        Test if the integer on top of the stack is less than the one
+        under it. The compiler puts the first argument on top, so
+        (LT 3 4) compiles to:
+
+        >>> s = SECD()
+        >>> s.load_program([LDC, 4, LDC, 3, LT, STOP])
+        >>> for _ in range(3): s.execute_opcode()
+        >>> s.get_value(s.registers['S'])
+        [1]
+        """
+
+        self.compare(LT)
+
+    def opcode_LE(self):
+        """
+        Test if the integer on top of the stack is less than or equal
+        to the one under it.
+
+        >>> s = SECD()
+        >>> s.load_program([LE], [4, 4])
+        >>> s.execute_opcode()
+        >>> s.get_value(s.registers['S'])
+        [1]
+        """
+
+        self.compare(LE)
+
+    def opcode_GT(self):
+        """
+        Test if the integer on top of the stack is greater than the
+        one under it.
+
+        >>> s = SECD()
+        >>> s.load_program([GT], [4, 5])
+        >>> s.execute_opcode()
+        >>> s.get_value(s.registers['S'])
+        [0]
+        """
+
+        self.compare(GT)
+
+    def opcode_GE(self):
+        """
+        Test if the integer on top of the stack is greater than or
+        equal to the one under it.
+
+        >>> s = SECD()
+        >>> s.load_program([GE], [5, 4])
+        >>> s.execute_opcode()
+        >>> s.get_value(s.registers['S'])
+        [1]
+        """
+
+        self.compare(GE)
+
+    def opcode_NIL(self):
+        """
+        Push an empty list (nil) onto the stack. See also CONS.
+
+        >>> s = SECD()
+        >>> s.load_program([NIL], [18, 19])
+        >>> s.get_value(s.registers['S'])
+        [18, 19]
+        >>> s.execute_opcode()
+        >>> s.dump_registers()
+        S: address = 13 value: [[], 18, 19]
+        E: address = 3 value: []
+        C: address = 7 value: 7
+        D: address = 4 value: []
+        """
+
+        assert self.get_int(self.car(self.registers['C'])) == NIL
+
+        new_cell = self.get_new_address()
+        self.set_nonterminal(new_cell, 0, 0)
+        self.push_stack('S', new_cell)
+
+        self.registers['C'] = self.cdr(self.registers['C'])
+
+    def opcode_LDC(self):
+        """
+        Load a constant onto the stack. The constant expression
+        is whatever follows LDC in C, so it may be an arbitrary
+        s-expression.
+
+        >>> s = SECD()
+        >>> s.load_program([LDC, 3], [18, 19])
+        >>> s.execute_opcode()
+        >>> s.dump_registers()
+        S: address = 14 value: [3, 18, 19]
+        E: address = 3 value: []
+        C: address = 9 value: 9
+        D: address = 4 value: []
+
+        >>> s = SECD()
+        >>> s.load_program([LDC, [3, 4, [18]]], [1])
         >>> s.execute_opcode()
         >>> s.dump_registers()
         S: address = 20 value: [[3, 4, [18]], 1]
@@ -778,7 +1745,7 @@ class SECD:
 
         >>> s.execute_opcode()
         >>> s.dump_registers()
-        S: address = 53 value: [[['LD', [1, 2], 'LD', [1, 1], 'ADD', 'RTN'], [[99, 999]]], [3, 4], 500]
+        S: address = 54 value: [[['LD', [1, 2], 'LD', [1, 1], 'ADD', 'RTN'], [[99, 999]]], [3, 4], 500]
         E: address = 3 value: [[99, 999]]
         C: address = 17 value: 17
         D: address = 4 value: []
@@ -790,10 +1757,10 @@ class SECD:
 
         >>> s.execute_opcode()
         >>> s.dump_registers()
-        S: address = 60 value: []
-        E: address = 61 value: [[3, 4], [99, 999]]
+        S: address = 56 value: []
+        E: address = 57 value: [[3, 4], [99, 999]]
         C: address = 16 value: 16
-        D: address = 59 value: [['WRITEI', 'STOP'], [[99, 999]], [500]]
+        D: address = 55 value: [['WRITEI', 'STOP'], [[99, 999]], [500]]
 
         Now we can execute the function itself:
 
@@ -848,18 +1815,12 @@ class SECD:
         # The code after the LDF (the function itself):
         code = self.car(self.cdr(self.registers['C']))
 
-        # The closure consists of code and E_head:
-        new_cell_0 = self.get_new_address()
-        new_cell_1 = self.get_new_address()
-        new_cell_2 = self.get_new_address()
-        new_cell_3 = self.get_new_address()
+        # The closure consists of code and E_head, in a single cell:
+        closure = self.get_new_address()
+        self.set_closure(closure, code, E_head)
 
         # Push the closure onto the stack:
-        self.set_nonterminal(new_cell_0, new_cell_1, self.registers['S'])
-        self.set_nonterminal(new_cell_1, code,       new_cell_2)
-        self.set_nonterminal(new_cell_2, E_head,     new_cell_3)
-        self.set_nonterminal(new_cell_3, 0, 0)
-        self.registers['S'] = new_cell_0
+        self.push_stack('S', closure)
 
         self.registers['C'] = self.cdr(self.registers['C']) # skip LDF
         self.registers['C'] = self.cdr(self.registers['C']) # skip the code
@@ -880,27 +1841,30 @@ class SECD:
 
         assert self.get_int(self.car(self.registers['C'])) == AP
 
+        if self.memo is not None and self.memo_lookup(self.car(self.cdr(self.registers['S'])),
+                                                      self.cdr(self.cdr(self.registers['S'])),
+                                                      self.cdr(self.registers['C'])):
+            return
+
         # We must save a copy of certain parts of S, E, and C on the dump
         # before running the function's code.
 
         # The cddr of S contains the stack after the closure and the function
         # parameters. We save this on the dump.
         if self.debug: print 'opcode_AP: saving this part of S: ', self.get_value(self.cdr(self.cdr(self.registers['S'])))
-        self.push_stack('D', self.cdr(self.cdr(self.registers['S'])))
 
         # The environment E contains variable values specified by earlier
         # code; after the function executes we want this to be restored to its
         # original value.
         if self.debug: print 'opcode_AP: saving E: ', self.get_value(self.registers['E'])
-        self.push_stack('D', self.registers['E'])
 
         # The cdr of C is the instruction immediately after the AP, and we
         # want to continue at that point after executing the function.
         if self.debug: print 'opcode_AP: part of C to save: ', self.get_value(self.cdr(self.registers['C']))
-        self.push_stack('D', self.cdr(self.registers['C']))
 
-        closure_code        = self.car(self.car(self.registers['S']))
-        closure_environment = self.car(self.cdr(self.car(self.registers['S'])))
+        self.push_dump(self.cdr(self.cdr(self.registers['S'])), self.registers['E'], self.cdr(self.registers['C']))
+
+        closure_code, closure_environment = self.get_closure(self.car(self.registers['S']))
         second_element_of_S = self.car(self.cdr(self.registers['S']))
 
         if self.debug:
@@ -921,23 +1885,104 @@ class SECD:
         self.set_nonterminal(new_cell, second_element_of_S, closure_environment)
         self.registers['E'] = new_cell
 
-    def opcode_JOIN(self):
+    def apply_frame(self, k, after):
         """
-        Return to a location specified by the top element of the
-        dump. Typically used in conjunction with SEL. For a longer
-        example see opcode_SEL().
+        Shared part of AP1, AP2 and APN. Like AP, but the k arguments
+        are taken straight off the stack, from under the closure, into
+        a single frame cell rather than being consed into a list
+        first. The first argument is the one nearest the top.
+        """
+
+        closure = self.car(self.registers['S'])
+
+        args = []
+        rest = self.cdr(self.registers['S'])
+        for _ in range(k):
+            args.append(self.car(rest))
+            rest = self.cdr(rest)
+
+        if self.memo is not None and self.memo_lookup(args, rest, after):
+            return
+
+        self.push_dump(rest, self.registers['E'], after)
+
+        self.registers['S'] = self.get_new_address()
+        self.set_nonterminal(self.registers['S'], 0, 0)
+
+        code, env = self.get_closure(closure)
+        self.registers['C'] = code
+
+        frame = self.get_new_address()
+        self.memory[frame] = (TAG_FRAME, args)
+
+        new_cell = self.get_new_address()
+        self.set_nonterminal(new_cell, frame, env)
+        self.registers['E'] = new_cell
+
+    def opcode_AP1(self):
+        """
+        Apply the closure on top of the stack to the one value under
+        it.
 
         >>> s = SECD()
-        >>> s.load_program([JOIN], [])
-        >>> new_cell = s.get_new_address()
-        >>> s.set_int(new_cell, 100)
-        >>> s.push_stack('D', new_cell)
+        >>> s.load_program([LDC, 3, LDF, [LD, [1, 1], LD, [1, 1], MUL, RTN], AP1, WRITEI, STOP], [500])
+        >>> for _ in range(8): s.execute_opcode()
+        9
+        >>> s.get_value(s.registers['S'])
+        [500]
+        """
+
+        assert self.get_int(self.car(self.registers['C'])) == AP1
+        self.apply_frame(1, self.cdr(self.registers['C']))
+
+    def opcode_AP2(self):
+        """
+        Apply the closure on top of the stack to the two values under
+        it. Compare the example in opcode_RTN(), which uses AP:
+
+        >>> s = SECD()
+        >>> s.load_program([LDC, 3, LDC, 4, LDF, [LD, [1, 2], LD, [1, 1], SUB, RTN], AP2, WRITEI, STOP], [500])
+        >>> for _ in range(9): s.execute_opcode()
+        1
+        >>> s.get_value(s.registers['S'])
+        [500]
+        """
+
+        assert self.get_int(self.car(self.registers['C'])) == AP2
+        self.apply_frame(2, self.cdr(self.registers['C']))
+
+    def opcode_APN(self):
+        """
+        Apply the closure on top of the stack to the k values under
+        it, where k follows the APN.
+
+        >>> s = SECD()
+        >>> s.load_program([LDC, 3, LDC, 2, LDC, 1, LDF, [LD, [1, 3], RTN], APN, 3, WRITEI, STOP])
+        >>> for _ in range(8): s.execute_opcode()
+        3
         >>> s.dump_registers()
         S: address = 2 value: []
         E: address = 3 value: []
-        C: address = 5 value: 5
-        D: address = 9 value: [100]
+        C: address = 37 value: 37
+        D: address = 4 value: []
+        """
+
+        assert self.get_int(self.car(self.registers['C'])) == APN
+
+        k = self.get_int(self.car(self.cdr(self.registers['C'])))
+        self.apply_frame(k, self.cdr(self.cdr(self.registers['C'])))
+
+    def opcode_JOIN(self):
+        """
+        Return to the location saved by the matching SEL. Kogge keeps
+        this location on the dump; we keep it on the join stack
+        instead, so a conditional allocates no cells. The dump only
+        ever holds the S, E and C saved by AP and RAP. For a longer
+        example see opcode_SEL().
 
+        >>> s = SECD()
+        >>> s.load_program([JOIN], [])
+        >>> s.join_stack.append(100)
         >>> s.execute_opcode()
         >>> s.dump_registers()
         S: address = 2 value: []
@@ -949,13 +1994,9 @@ class SECD:
 
         assert self.get_int(self.car(self.registers['C'])) == JOIN
 
-        # Pop a value off the dump stack (a pointer):
-        assert self.car(self.registers['D']) != 0
-        new_C = self.get_int(self.car(self.registers['D']))
-        self.registers['D'] = self.cdr(self.registers['D'])
-
-        # Set the program counter to this new location
-        self.registers['C'] = new_C
+        # Pop the return point and set the program counter to it:
+        assert len(self.join_stack) > 0
+        self.registers['C'] = self.join_stack.pop()
 
 
     def opcode_RTN(self):
@@ -988,7 +2029,7 @@ class SECD:
         <BLANKLINE>
 
         >>> s.dump_registers()
-        S: address = 69 value: [[9, 8, 7], 500]
+        S: address = 64 value: [[9, 8, 7], 500]
         E: address = 3 value: []
         C: address = 49 value: 49
         D: address = 4 value: []
@@ -997,28 +2038,24 @@ class SECD:
 
         assert self.get_int(self.car(self.registers['C'])) == RTN
 
-        # We pushed S, E, and C onto the dump, so they'll come off
-        # in the reverse order:
+        if self.memo is not None:
+            self.memo_store(self.memo_frames.pop(), self.car(self.registers['S']))
 
-        old_C = self.car(self.registers['D'])
+        # Pop the S, E, and C saved by the application; the dump cell
+        # goes on the free list.
+        old_S, old_E, old_C = self.pop_dump()
         if self.debug:
             print 'opcode_RTN: old_C:', self.get_value(old_C)
-
-        old_E = self.car(self.cdr(self.registers['D']))
-        if self.debug:
             print 'opcode_RTN: cur_E:', self.get_value(self.registers['E'])
             print 'opcode_RTN: old_E:', self.get_value(old_E)
-
-        old_S = self.car(self.cdr(self.cdr(self.registers['D'])))
-        if self.debug:
             print 'opcode_RTN: old_S:', self.get_value(old_S)
 
         # The result of the previous AP will be on the top of the current stack,
-        # so we cons this onto the front of the old stack. We take JUST ONE
-        # element off the top of the stack.
-        new_S = self.get_new_address()
-        self.set_nonterminal(new_S, self.car(self.registers['S']), old_S)
-        self.registers['S'] = new_S
+        # so we link it onto the front of the old stack. We take JUST ONE
+        # element off the top of the stack. The top cell of the function's
+        # stack was made during the call and nothing else refers to it, so it
+        # is reused rather than allocating a new one.
+        self.set_nonterminal(self.registers['S'], self.car(self.registers['S']), old_S)
         if self.debug:
             print 'opcode_RTN: S is now:', self.get_value(self.registers['S'])
 
@@ -1030,11 +2067,6 @@ class SECD:
             print 'opcode_RTN: restored E:', self.get_value(self.registers['E'])
             print 'opcode_RTN: restored C:', self.get_value(self.registers['C'])
 
-        # Pop the dump
-        self.pop_stack('D') # C
-        self.pop_stack('D') # E
-        self.pop_stack('D') # S
-
     def opcode_SEL(self):
         """
         Boolean selection based on the element on the top of the stack
@@ -1071,12 +2103,32 @@ class SECD:
         value = self.get_int(self.car(self.registers['S']))
         self.pop_stack('S')
 
-        # Code point after the two branches for the SEL opcode:
-        after_sel_address = self.get_new_address()
-        self.set_int(after_sel_address, self.cdr(self.cdr(self.cdr(self.registers['C']))))
+        self.select(value)
 
-        # Push this address onto the dump:
-        self.push_stack('D', after_sel_address)
+    def select(self, value):
+        """
+        Shared tail of SEL and the fused BRxx opcodes. C points at
+        the selecting opcode, which is followed by the two branches.
+        We save the code point after the branches on the join stack
+        (JOIN returns there) and follow the first branch if 'value' is true,
+        otherwise the second.
+
+        A selection at the end of a function returns from its branches,
+        and leaves nothing on the join stack:
+
+        >>> s = SECD()
+        >>> s.halt_stream = None
+        >>> s.load_program([LDC, [0], LDF, [LD, [1, 1], BRZ, [LDC, 5, RTN], [LDC, 6, RTN]], AP, STOP])
+        >>> s.run(), s.join_stack
+        (5, [])
+        """
+
+        # Code point after the two branches, for JOIN. If there is none
+        # the selection is in tail position and its branches end in RTN
+        # (see peephole.py), so there is nothing to join.
+        after = self.cdr(self.cdr(self.cdr(self.registers['C'])))
+        if self.memory[after] != (TAG_NONTERMINAL, 0, 0):
+            self.join_stack.append(after)
 
         # Follow the if or the else branch:
         if value:
@@ -1084,6 +2136,92 @@ class SECD:
         else:
             self.registers['C'] = self.car(self.cdr(self.cdr(self.registers['C'])))
 
+    def opcode_BRZ(self):
+        """
+        Fused ZEROP and SEL. Pop an integer off the stack and follow
+        the first branch if it is zero, otherwise the second. Unlike
+        ZEROP the tested value is consumed, and no boolean cell is
+        allocated.
+
+        >>> s = SECD()
+        >>> s.load_program([BRZ, [LDC, 111, JOIN], [LDC, 222, JOIN], WRITEI], [0, 999])
+        >>> for _ in range(4): s.execute_opcode()
+        111
+        >>> s.get_value(s.registers['S'])
+        [999]
+
+        >>> s = SECD()
+        >>> s.load_program([BRZ, [LDC, 111, JOIN], [LDC, 222, JOIN], WRITEI], [5, 999])
+        >>> for _ in range(4): s.execute_opcode()
+        222
+        """
+
+        assert self.get_int(self.car(self.registers['C'])) == BRZ
+
+        value = self.get_int(self.car(self.registers['S']))
+        self.pop_stack('S')
+
+        self.select(value == 0)
+
+    def opcode_BRGT0(self):
+        """
+        Fused GT0P and SEL: pop an integer and follow the first
+        branch if it is greater than zero.
+
+        >>> s = SECD()
+        >>> s.load_program([BRGT0, [LDC, 111, JOIN], [LDC, 222, JOIN], WRITEI, BRGT0, [LDC, 111, JOIN], [LDC, 222, JOIN], WRITEI], [3, 0])
+        >>> for _ in range(8): s.execute_opcode()
+        111
+        222
+        """
+
+        assert self.get_int(self.car(self.registers['C'])) == BRGT0
+
+        value = self.get_int(self.car(self.registers['S']))
+        self.pop_stack('S')
+
+        self.select(value > 0)
+
+    def opcode_BRLT0(self):
+        """
+        Fused LT0P and SEL: pop an integer and follow the first
+        branch if it is less than zero.
+
+        >>> s = SECD()
+        >>> s.load_program([BRLT0, [LDC, 111, JOIN], [LDC, 222, JOIN], WRITEI, BRLT0, [LDC, 111, JOIN], [LDC, 222, JOIN], WRITEI], [-3, 0])
+        >>> for _ in range(8): s.execute_opcode()
+        111
+        222
+        """
+
+        assert self.get_int(self.car(self.registers['C'])) == BRLT0
+
+        value = self.get_int(self.car(self.registers['S']))
+        self.pop_stack('S')
+
+        self.select(value < 0)
+
+    def opcode_BRNULL(self):
+        """
+        Fused NULL and SEL: pop a list and follow the first branch if
+        it is empty.
+
+        >>> s = SECD()
+        >>> s.load_program([BRNULL, [LDC, 111, JOIN], [LDC, 222, JOIN], WRITEI, BRNULL, [LDC, 111, JOIN], [LDC, 222, JOIN], WRITEI], [[], [1, 2]])
+        >>> for _ in range(8): s.execute_opcode()
+        111
+        222
+        """
+
+        assert self.get_int(self.car(self.registers['C'])) == BRNULL
+
+        self.force(self.car(self.registers['S']))
+        value = self.memory[self.car(self.registers['S'])]
+        assert value[0] == TAG_NONTERMINAL
+        self.pop_stack('S')
+
+        self.select(value[1] == 0 and value[2] == 0)
+
     def opcode_NULL(self):
         """
         Test if the list on the stack is empty. We do not pop the
@@ -1111,6 +2249,7 @@ class SECD:
 
         assert self.get_int(self.car(self.registers['C'])) == NULL
 
+        self.force(self.car(self.registers['S']))
         value = self.memory[self.car(self.registers['S'])]
         assert value[0] == TAG_NONTERMINAL
 
@@ -1239,6 +2378,70 @@ class SECD:
 
         self.registers['C'] = self.cdr(self.registers['C'])
 
+    def set_input(self, data):
+        """
+        Pre-fill the input buffer with the string 'data'. READI and
+        READC then read from the buffer, without prompting, instead of
+        from the terminal.
+
+        >>> s = SECD()
+        >>> s.set_input('12 -7 ok')
+        >>> s.load_program([READI, READI, ADD, WRITEI, READC, READC, READC, READC, READC], [])
+        >>> for _ in range(9): s.execute_opcode()
+        5
+        >>> s.get_value(s.registers['S'])
+        [-1, -1, 107, 111, 32]
+        """
+
+        self.input_buffer = data
+        self.input_pos    = 0
+
+    def buffer_output(self, flush_size=OUTPUT_FLUSH_SIZE):
+        """
+        Collect output from WRITEI, WRITEC and WRITEB in a bytearray
+        and write it to the output stream in blocks of 'flush_size'
+        bytes instead of once per value. STOP flushes the buffer; call
+        flush_output() to do so earlier.
+
+        >>> s = SECD()
+        >>> s.buffer_output()
+        >>> s.load_program([WRITEB, WRITEB, WRITEB, WRITEI, STOP], [104, 105, 10, 42])
+        >>> for _ in range(4): s.execute_opcode()
+        >>> str(s.output_buffer)
+        'hi\\n42\\n'
+        >>> s.execute_opcode()
+        hi
+        42
+        <BLANKLINE>
+        MACHINE HALTED!
+        <BLANKLINE>
+        """
+
+        self.output_buffer = bytearray()
+        self.output_flush_size = flush_size
+
+    def write_output(self, x):
+        """
+        Write the string x to the output stream, or to the output
+        buffer if buffer_output() has been called.
+        """
+
+        if self.output_buffer is None:
+            self.output_stream.write(x)
+        else:
+            self.output_buffer.extend(x)
+            if len(self.output_buffer) >= self.output_flush_size:
+                self.flush_output()
+
+    def flush_output(self):
+        """
+        Write any buffered output to the output stream.
+        """
+
+        if self.output_buffer:
+            self.output_stream.write(str(self.output_buffer))
+            self.output_buffer = bytearray()
+
     def opcode_WRITEI(self):
         """
         Write an integer to the console. Takes its argument from the stack.
@@ -1249,10 +2452,13 @@ class SECD:
         1234
         """
 
+        if self.memo is not None:
+            self.memo_taint()
+
         value = self.get_int(self.car(self.registers['S']))
         self.pop_stack('S')
 
-        self.output_stream.write(str(value) + '\n')
+        self.write_output(str(value) + '\n')
 
         self.registers['C'] = self.cdr(self.registers['C'])
 
@@ -1267,10 +2473,36 @@ class SECD:
         a
         """
 
+        if self.memo is not None:
+            self.memo_taint()
+
         value = self.get_int(self.car(self.registers['S']))
         self.pop_stack('S')
 
-        self.output_stream.write(chr(value) + '\n')
+        self.write_output(chr(value) + '\n')
+
+        self.registers['C'] = self.cdr(self.registers['C'])
+
+    def opcode_WRITEB(self):
+        """
+        Write a single byte to the console. Unlike WRITEC no newline
+        is added, so this is the opcode to use for bulk text output.
+
+        >>> s = SECD()
+        >>> s.load_program([WRITEB, WRITEB, WRITEB], [111, 107, 10])
+        >>> for _ in range(3): s.execute_opcode()
+        ok
+        """
+
+        assert self.get_int(self.car(self.registers['C'])) == WRITEB
+
+        if self.memo is not None:
+            self.memo_taint()
+
+        value = self.get_int(self.car(self.registers['S']))
+        self.pop_stack('S')
+
+        self.write_output(chr(value))
 
         self.registers['C'] = self.cdr(self.registers['C'])
 
@@ -1278,6 +2510,10 @@ class SECD:
         """
         Read an integer from the console.
 
+        If set_input() has been called the next integer is taken
+        from the input buffer, with no prompt. Otherwise we prompt on
+        the output stream and read a line from the input stream.
+
         This doctest relies on stdin being '42'. Note the trailing
         whitespace after the '?' as well (it is part of the prompt).
 
@@ -1287,9 +2523,33 @@ class SECD:
         ? 
         >>> s.execute_opcode()
         42
+
+        Like READC, READI reads from the machine's input stream:
+
+        >>> from StringIO import StringIO
+        >>> s = SECD()
+        >>> s.input_stream = StringIO('7\\n')
+        >>> s.load_program([READI], [])
+        >>> s.execute_opcode()
+        ? 
+        >>> s.get_value(s.registers['S'])
+        [7]
         """
 
-        i = int(raw_input('? '))
+        assert self.get_int(self.car(self.registers['C'])) == READI
+
+        if self.memo is not None:
+            self.memo_taint()
+
+        if self.input_buffer is None:
+            self.flush_output()
+            self.output_stream.write('? ')
+            i = int(self.input_stream.readline())
+        else:
+            match = INPUT_INT_RE.match(self.input_buffer, self.input_pos)
+            assert match is not None, 'READI: no integer in input'
+            i = int(match.group(1))
+            self.input_pos = match.end()
 
         new_cell = self.get_new_address()
         self.set_int(new_cell, i)
@@ -1297,18 +2557,44 @@ class SECD:
 
         self.registers['C'] = self.cdr(self.registers['C'])
 
+    def opcode_READC(self):
+        """
+        Read a single character and push its code, or -1 at the end of
+        the input. Reads from the input buffer if set_input() has been
+        called, otherwise from the input stream. For an example see
+        set_input().
+        """
+
+        assert self.get_int(self.car(self.registers['C'])) == READC
+
+        if self.memo is not None:
+            self.memo_taint()
+
+        if self.input_buffer is None:
+            c = self.input_stream.read(1)
+        else:
+            c = self.input_buffer[self.input_pos:self.input_pos + 1]
+            self.input_pos += len(c)
+
+        new_cell = self.get_new_address()
+        self.set_int(new_cell, ord(c) if c else -1)
+        self.push_stack('S', new_cell)
+
+        self.registers['C'] = self.cdr(self.registers['C'])
 
     def opcode_STOP(self):
         """
         Half the machine. Any future call to execute_opcode() results
-        in an error.
+        in an error. Buffered output is flushed and the banner is
+        written to halt_stream.
         """
 
         self.running = False
 
-        print
-        print 'MACHINE HALTED!'
-        print
+        self.flush_output()
+
+        if self.halt_stream is not None:
+            self.halt_stream.write('\nMACHINE HALTED!\n\n')
 
     def opcode_CAR(self):
         """
@@ -1392,16 +2678,25 @@ class SECD:
         E: address = 3 value: []
         C: address = 11 value: 11
         D: address = 4 value: []
+
+        The list itself is left alone:
+
+        >>> s = SECD()
+        >>> s.load_program([LDC, [[10, 20]], LDF, [LD, [1, 1], CDR, CAR, LD, [1, 1], CAR, ADD, RTN], AP, STOP])
+        >>> s.halt_stream = None
+        >>> s.run()
+        30
         """
 
         assert self.get_int(self.car(self.registers['C'])) == CDR
 
         head_address = self.car(self.registers['S'])
 
-        self.set_nonterminal(head_address, self.car(self.cdr(head_address)),
-                                           self.cdr(self.cdr(head_address)))
-
-        assert self.get_int(self.car(self.registers['C'])) == CDR
+        # Point the top of the stack at the tail of the list. The list
+        # itself may be shared (with a variable, or a constant in the
+        # program) so we must not overwrite it.
+        self.set_nonterminal(self.registers['S'], self.cdr(head_address),
+                                                  self.cdr(self.registers['S']))
 
         self.registers['C'] = self.cdr(self.registers['C'])
 
@@ -1490,6 +2785,456 @@ class SECD:
 
         self.registers['C'] = self.cdr(self.registers['C'])
 
+    def opcode_LENGTH(self):
+        """
+        Length of the list on the top of the stack. The list is walked
+        in a Python loop rather than by interpreted SECD code, compare
+        the example in opcode_RAP().
+
+        >>> s = SECD()
+        >>> s.load_program([LENGTH], [[1, 2, 3], 999])
+        >>> s.execute_opcode()
+        >>> s.get_value(s.registers['S'])
+        [3, 999]
+        """
+
+        assert self.get_int(self.car(self.registers['C'])) == LENGTH
+
+        x = self.car(self.registers['S'])
+        self.pop_stack('S')
+
+        n = 0
+        while self.car(x) != 0:
+            n += 1
+            x = self.cdr(x)
+
+        result = self.get_new_address()
+        self.set_int(result, n)
+        self.push_stack('S', result)
+
+        self.registers['C'] = self.cdr(self.registers['C'])
+
+    def opcode_APPEND(self):
+        """
+        Append the list second on the stack to the list on the top of
+        the stack. The cells of the first list are copied and the
+        second list is shared, as in Lisp.
+
+        >>> s = SECD()
+        >>> s.load_program([APPEND], [[1, 2], [3, [4]]])
+        >>> s.execute_opcode()
+        >>> s.get_value(s.registers['S'])
+        [[1, 2, 3, [4]]]
+        """
+
+        assert self.get_int(self.car(self.registers['C'])) == APPEND
+
+        x = self.car(self.registers['S'])
+        self.pop_stack('S')
+
+        y = self.car(self.registers['S'])
+        self.pop_stack('S')
+
+        items = []
+        while self.car(x) != 0:
+            items.append(self.car(x))
+            x = self.cdr(x)
+
+        for item in reversed(items):
+            new_cell = self.get_new_address()
+            self.set_nonterminal(new_cell, item, y)
+            y = new_cell
+
+        self.push_stack('S', y)
+
+        self.registers['C'] = self.cdr(self.registers['C'])
+
+    def opcode_REVERSE(self):
+        """
+        Reverse the list on the top of the stack, as a new list.
+
+        >>> s = SECD()
+        >>> s.load_program([REVERSE], [[1, [2], 3]])
+        >>> s.execute_opcode()
+        >>> s.get_value(s.registers['S'])
+        [[3, [2], 1]]
+        """
+
+        assert self.get_int(self.car(self.registers['C'])) == REVERSE
+
+        x = self.car(self.registers['S'])
+        self.pop_stack('S')
+
+        result = self.get_new_address()
+        self.set_nonterminal(result, 0, 0)
+
+        while self.car(x) != 0:
+            new_cell = self.get_new_address()
+            self.set_nonterminal(new_cell, self.car(x), result)
+            result = new_cell
+            x = self.cdr(x)
+
+        self.push_stack('S', result)
+
+        self.registers['C'] = self.cdr(self.registers['C'])
+
+    def opcode_NTH(self):
+        """
+        Element n of a list, counting from zero, where n is on the top
+        of the stack and the list is below it.
+
+        >>> s = SECD()
+        >>> s.load_program([NTH], [2, [10, 20, 30, 40]])
+        >>> s.execute_opcode()
+        >>> s.get_value(s.registers['S'])
+        [30]
+        """
+
+        assert self.get_int(self.car(self.registers['C'])) == NTH
+
+        n = self.get_int(self.car(self.registers['S']))
+        self.pop_stack('S')
+
+        x = self.car(self.registers['S'])
+        self.pop_stack('S')
+
+        for _ in xrange(n):
+            assert self.car(x) != 0, 'NTH: list too short'
+            x = self.cdr(x)
+
+        assert self.car(x) != 0, 'NTH: list too short'
+        self.push_stack('S', self.car(x))
+
+        self.registers['C'] = self.cdr(self.registers['C'])
+
+    def opcode_EQUAL(self):
+        """
+        Structural equality of the top two elements of the stack.
+        Pushes 1 if they are equal and 0 otherwise.
+
+        >>> s = SECD()
+        >>> s.load_program([EQUAL, EQUAL], [[1, [2, 3]], [1, [2, 3]], [1, [2]]])
+        >>> s.execute_opcode()
+        >>> s.get_value(s.registers['S'])
+        [1, [1, [2]]]
+        >>> s.execute_opcode()
+        >>> s.get_value(s.registers['S'])
+        [0]
+        """
+
+        assert self.get_int(self.car(self.registers['C'])) == EQUAL
+
+        x = self.car(self.registers['S'])
+        self.pop_stack('S')
+
+        y = self.car(self.registers['S'])
+        self.pop_stack('S')
+
+        result = self.get_new_address()
+        self.set_int(result, int(self.equal(x, y)))
+        self.push_stack('S', result)
+
+        self.registers['C'] = self.cdr(self.registers['C'])
+
+    def equal(self, x, y):
+        """
+        Structural equality of the values at addresses x and y. We
+        use an explicit stack, and pairs of cells already being
+        compared are assumed equal so that cyclic structures (made by
+        DUM/RAP) terminate. Comparing vectors reads their contents, so
+        the calls in progress are not memoised.
+        """
+
+        seen  = {}
+        stack = [(x, y)]
+
+        while stack:
+            x, y = stack.pop()
+            if x == y or (x, y) in seen:
+                continue
+            seen[(x, y)] = True
+
+            if x == 0 or y == 0:
+                return False
+
+            self.force(x)
+            self.force(y)
+
+            cell_x = self.memory[x]
+            cell_y = self.memory[y]
+
+            if cell_x[0] != cell_y[0]:
+                return False
+            elif cell_x[0] == TAG_INTEGER:
+                if cell_x[1] != cell_y[1]:
+                    return False
+            elif cell_x[0] == TAG_VECTOR:
+                # The answer depends on the vectors' current contents:
+                if self.memo is not None:
+                    self.memo_taint()
+                if list(cell_x[1]) != list(cell_y[1]):
+                    return False
+            elif cell_x[0] == TAG_FRAME:
+                if len(cell_x[1]) != len(cell_y[1]):
+                    return False
+                stack.extend(zip(cell_x[1], cell_y[1]))
+            else:
+                stack.append((cell_x[1], cell_y[1]))
+                stack.append((cell_x[2], cell_y[2]))
+
+        return True
+
+    def opcode_VEC(self):
+        """
+        Make a new integer vector. The argument on the stack is either
+        a length, giving a vector of zeros, or a list of integers.
+
+        >>> s = SECD()
+        >>> s.load_program([VEC], [[4, 5, 6]])
+        >>> s.execute_opcode()
+        >>> s.get_value(s.registers['S'])
+        [[4, 5, 6]]
+        >>> s.tag(s.car(s.registers['S']))
+        'VEC'
+
+        >>> s = SECD()
+        >>> s.load_program([VEC], [3])
+        >>> s.execute_opcode()
+        >>> s.get_value(s.registers['S'])
+        [[0, 0, 0]]
+        """
+
+        assert self.get_int(self.car(self.registers['C'])) == VEC
+
+        arg = self.car(self.registers['S'])
+        self.pop_stack('S')
+
+        if self.tag(arg) == TAG_INTEGER:
+            values = [0]*self.get_int(arg)
+        else:
+            values = []
+            while self.car(arg) != 0:
+                x = self.get_int(self.car(arg))
+                assert VECTOR_MIN <= x <= VECTOR_MAX, 'VEC: element out of range: %d' % x
+                values.append(x)
+                arg = self.cdr(arg)
+
+        result = self.get_new_address()
+        self.store_vector(result, values)
+        self.push_stack('S', result)
+
+        self.registers['C'] = self.cdr(self.registers['C'])
+
+    def opcode_VREF(self):
+        """
+        Element i of a vector, counting from zero. The vector is on the
+        top of the stack and i is below it.
+
+        >>> s = SECD()
+        >>> s.load_program([VEC, VREF], [[4, 5, 6], 2])
+        >>> s.execute_opcode()
+        >>> s.execute_opcode()
+        >>> s.get_value(s.registers['S'])
+        [6]
+
+        >>> s = SECD()
+        >>> s.load_program([VEC, VREF], [[4, 5, 6], -1])
+        >>> s.execute_opcode()
+        >>> s.execute_opcode()
+        Traceback (most recent call last):
+        ...
+        AssertionError: VREF: index out of range: -1
+        """
+
+        assert self.get_int(self.car(self.registers['C'])) == VREF
+
+        if self.memo is not None:
+            self.memo_taint()
+
+        v = self.get_vector(self.car(self.registers['S']))
+        self.pop_stack('S')
+
+        i = self.get_int(self.car(self.registers['S']))
+        self.pop_stack('S')
+
+        assert 0 <= i < len(v), 'VREF: index out of range: %d' % i
+
+        result = self.get_new_address()
+        self.set_int(result, int(v[i]))
+        self.push_stack('S', result)
+
+        self.registers['C'] = self.cdr(self.registers['C'])
+
+    def opcode_VSET(self):
+        """
+        Set element i of a vector to x, in place, and leave the vector
+        on the stack. The stack holds the vector, then i, then x.
+
+        >>> s = SECD()
+        >>> s.load_program([VEC, VSET], [3, 1, 42])
+        >>> s.execute_opcode()
+        >>> s.execute_opcode()
+        >>> s.get_value(s.registers['S'])
+        [[0, 42, 0]]
+        """
+
+        assert self.get_int(self.car(self.registers['C'])) == VSET
+
+        if self.memo is not None:
+            self.memo_taint()
+
+        address = self.car(self.registers['S'])
+        v = self.get_vector(address)
+        self.pop_stack('S')
+
+        i = self.get_int(self.car(self.registers['S']))
+        self.pop_stack('S')
+
+        x = self.get_int(self.car(self.registers['S']))
+        self.pop_stack('S')
+
+        assert 0 <= i < len(v), 'VSET: index out of range: %d' % i
+        assert VECTOR_MIN <= x <= VECTOR_MAX, 'VSET: element out of range: %d' % x
+
+        v[i] = x
+        self.push_stack('S', address)
+
+        self.registers['C'] = self.cdr(self.registers['C'])
+
+    def opcode_VLEN(self):
+        """
+        Length of a vector.
+
+        >>> s = SECD()
+        >>> s.load_program([VEC, VLEN], [7])
+        >>> s.execute_opcode()
+        >>> s.execute_opcode()
+        >>> s.get_value(s.registers['S'])
+        [7]
+        """
+
+        assert self.get_int(self.car(self.registers['C'])) == VLEN
+
+        if self.memo is not None:
+            self.memo_taint()
+
+        v = self.get_vector(self.car(self.registers['S']))
+        self.pop_stack('S')
+
+        result = self.get_new_address()
+        self.set_int(result, len(v))
+        self.push_stack('S', result)
+
+        self.registers['C'] = self.cdr(self.registers['C'])
+
+    def opcode_VADD(self):
+        """
+        Elementwise sum of two vectors of the same length, as a new
+        vector.
+
+        >>> s = SECD()
+        >>> s.load_program([VEC, VADD], [[1, 2, 3], 0])
+        >>> s.store_vector(s.car(s.cdr(s.registers['S'])), [10, 20, 30])
+        >>> s.execute_opcode()
+        >>> s.execute_opcode()
+        >>> s.get_value(s.registers['S'])
+        [[11, 22, 33]]
+        """
+
+        assert self.get_int(self.car(self.registers['C'])) == VADD
+
+        if self.memo is not None:
+            self.memo_taint()
+
+        v1 = self.get_vector(self.car(self.registers['S']))
+        self.pop_stack('S')
+
+        v2 = self.get_vector(self.car(self.registers['S']))
+        self.pop_stack('S')
+
+        assert len(v1) == len(v2)
+
+        result = self.get_new_address()
+        if numpy is not None:
+            total = v1 + v2
+            # numpy wraps around; the sum overflowed where its sign
+            # differs from the signs of both operands.
+            assert not ((v1 ^ total) & (v2 ^ total) < 0).any(), 'VADD: overflow'
+            self.memory[result] = (TAG_VECTOR, total)
+        else:
+            total = [x + y for (x, y) in zip(v1, v2)]
+            assert all(VECTOR_MIN <= x <= VECTOR_MAX for x in total), 'VADD: overflow'
+            self.store_vector(result, total)
+        self.push_stack('S', result)
+
+        self.registers['C'] = self.cdr(self.registers['C'])
+
+    def opcode_VSUM(self):
+        """
+        Sum of the elements of a vector.
+
+        >>> s = SECD()
+        >>> s.load_program([VEC, VSUM], [[1, 2, 3, 4]])
+        >>> s.execute_opcode()
+        >>> s.execute_opcode()
+        >>> s.get_value(s.registers['S'])
+        [10]
+
+        The numpy and array.array backends give the same results, and
+        both fail on overflow:
+
+        >>> import secd
+        >>> def run(program, vectors):
+        ...     s = SECD()
+        ...     s.load_program(program, [0]*len(vectors))
+        ...     cell = s.registers['S']
+        ...     for v in vectors:
+        ...         s.store_vector(s.car(cell), v)
+        ...         cell = s.cdr(cell)
+        ...     try:
+        ...         for _ in program: s.execute_opcode()
+        ...     except AssertionError, e:
+        ...         return str(e)
+        ...     return s.get_value(s.registers['S'])
+        >>> big = [VECTOR_MAX, 1]
+        >>> saved = secd.numpy
+        >>> results = []
+        >>> for backend in set([saved, None]):
+        ...     secd.numpy = backend
+        ...     results.append((run([VSUM], [[1, -2, 3]]), run([VSUM], [big]),
+        ...                     run([VADD], [big, [1, 1]]), run([VADD, VSUM], [[1, 2], [3, 4]])))
+        ...     secd.numpy = saved
+        >>> results[0]
+        ([2], 'VSUM: overflow', 'VADD: overflow', [10])
+        >>> all(r == results[0] for r in results)
+        True
+        """
+
+        assert self.get_int(self.car(self.registers['C'])) == VSUM
+
+        if self.memo is not None:
+            self.memo_taint()
+
+        v = self.get_vector(self.car(self.registers['S']))
+        self.pop_stack('S')
+
+        if numpy is None:
+            total = sum(v)
+        elif len(v) == 0:
+            total = 0
+        elif max(abs(int(v.max())), abs(int(v.min()))) * len(v) <= VECTOR_MAX:
+            total = int(v.sum()) # cannot wrap around
+        else:
+            total = sum(int(x) for x in v)
+
+        assert VECTOR_MIN <= total <= VECTOR_MAX, 'VSUM: overflow'
+
+        result = self.get_new_address()
+        self.set_int(result, total)
+        self.push_stack('S', result)
+
+        self.registers['C'] = self.cdr(self.registers['C'])
+
     def locate(self, ij, vlist):
         """
         Find the j-th element of the i-th sublist of vlist. Typically
@@ -1540,16 +3285,21 @@ class SECD:
 
         """
 
-        def loc(s, y, z):
-            assert type(y) == int
-            assert y >= 1
+        i = self.get_int(self.car(ij))
+        j = self.get_int(self.car(self.cdr(ij)))
+        assert i >= 1 and j >= 1
 
-            if y == 1:
-                return s.car(z)
-            else:
-                return loc(s, y - 1, s.cdr(z))
+        for _ in range(i - 1):
+            vlist = self.cdr(vlist)
+        frame = self.car(vlist)
 
-        return loc(self, self.get_int(self.car(self.cdr(ij))), loc(self, self.get_int(self.car(ij)), vlist))
+        # Frames made by AP1, AP2 and APN are indexed directly:
+        if self.memory[frame][0] == TAG_FRAME:
+            return self.memory[frame][1][j - 1]
+
+        for _ in range(j - 1):
+            frame = self.cdr(frame)
+        return self.car(frame)
 
     def opcode_LD(self):
         """
@@ -1689,7 +3439,7 @@ class SECD:
         The answer is 3, as left on the top of the stack:
 
         >>> s.dump_registers()
-        S: address = 232 value: [3, 500]
+        S: address = 205 value: [3, 500]
         E: address = 3 value: [[99, 999]]
         C: address = 123 value: 123
         D: address = 4 value: []
@@ -1718,7 +3468,7 @@ class SECD:
         The answer is 103, as left on the top of the stack:
 
         >>> s.dump_registers()
-        S: address = 232 value: [103, 500]
+        S: address = 205 value: [103, 500]
         E: address = 3 value: [[99, 999]]
         C: address = 123 value: 123
         D: address = 4 value: []
@@ -1758,7 +3508,7 @@ class SECD:
         The answer is 33, as left on the top of the stack:
 
         >>> s.dump_registers()
-        S: address = 313 value: [3, 500]
+        S: address = 284 value: [3, 500]
         E: address = 3 value: [[99, 999]]
         C: address = 199 value: 199
         D: address = 4 value: []
@@ -1795,7 +3545,7 @@ class SECD:
         The answer is 33, as left on the top of the stack:
 
         >>> s.dump_registers()
-        S: address = 313 value: [33, 500]
+        S: address = 284 value: [33, 500]
         E: address = 3 value: [[99, 999]]
         C: address = 199 value: 199
         D: address = 4 value: []
@@ -1835,7 +3585,7 @@ class SECD:
         as left on the top of the stack:
 
         >>> s.dump_registers()
-        S: address = 313 value: [23, 500]
+        S: address = 284 value: [23, 500]
         E: address = 3 value: [[99, 999]]
         C: address = 199 value: 199
         D: address = 4 value: []
@@ -1844,6 +3594,9 @@ class SECD:
 
         assert self.get_int(self.car(self.registers['C'])) == RAP
 
+        if self.memo is not None:
+            self.memo_frames.append(None)
+
         if self.debug:
             # The stack should be in a similar state as when an AP is used.
 
@@ -1865,7 +3618,6 @@ class SECD:
         # The cddr of S contains the stack after the closure and the function
         # parameters. We save this on the dump.
         if self.debug: print 'opcode_RAP: saving this part of S: ', self.get_value(self.cdr(self.cdr(self.registers['S'])))
-        self.push_stack('D', self.cdr(self.cdr(self.registers['S'])))
 
         # The environment E contains variable values specified by earlier
         # code; after the function executes we want this to be restored to its
@@ -1875,15 +3627,14 @@ class SECD:
         if self.debug: print 'opcode_RAP: saving cdr of E: ', self.get_value(self.cdr(self.registers['E']))
         assert self.memory[self.registers['E']][0] == TAG_NONTERMINAL
         assert self.memory[self.registers['E']][1] == 0 # this is the nil ptr
-        self.push_stack('D', self.cdr(self.registers['E']))
 
         # The cdr of C is the instruction immediately after the AP, and we
         # want to continue at that point after executing the function.
         if self.debug: print 'opcode_RAP: part of C to save: ', self.get_value(self.cdr(self.registers['C']))
-        self.push_stack('D', self.cdr(self.registers['C']))
 
-        closure_code        = self.car(self.car(self.registers['S']))
-        closure_environment = self.car(self.cdr(self.car(self.registers['S'])))
+        self.push_dump(self.cdr(self.cdr(self.registers['S'])), self.cdr(self.registers['E']), self.cdr(self.registers['C']))
+
+        closure_code, closure_environment = self.get_closure(self.car(self.registers['S']))
         second_element_of_S = self.car(self.cdr(self.registers['S']))
 
         if self.debug:
@@ -1912,11 +3663,15 @@ class SECD:
 
         assert self.running
 
-        op_code = self.get_int(self.car(self.registers['C']))
+        c = self.registers['C']
+        op_code = self.get_int(self.car(c))
         assert op_code in OP_CODES
 
         if self.debug:
-            print 'execute_opcode:', op_code
+            if c in self.source:
+                print 'execute_opcode:', op_code, '%s, at %s' % self.source[c]
+            else:
+                print 'execute_opcode:', op_code
 
         op = {ADD:    self.opcode_ADD,
               MUL:    self.opcode_MUL,
@@ -1942,8 +3697,9 @@ class SECD:
 
               WRITEI: self.opcode_WRITEI,
               WRITEC: self.opcode_WRITEC,
+              WRITEB: self.opcode_WRITEB,
 
-              READC:  None, # not implemented
+              READC:  self.opcode_READC,
               READI:  self.opcode_READI,
 
               STOP:   self.opcode_STOP,
@@ -1952,9 +3708,48 @@ class SECD:
               GT0P:   self.opcode_GT0P,
               LT0P:   self.opcode_LT0P,
 
+              LENGTH:  self.opcode_LENGTH,
+              APPEND:  self.opcode_APPEND,
+              REVERSE: self.opcode_REVERSE,
+              NTH:     self.opcode_NTH,
+              EQUAL:   self.opcode_EQUAL,
+
+              VEC:    self.opcode_VEC,
+              VREF:   self.opcode_VREF,
+              VSET:   self.opcode_VSET,
+              VLEN:   self.opcode_VLEN,
+              VADD:   self.opcode_VADD,
+              VSUM:   self.opcode_VSUM,
+
+              BRZ:    self.opcode_BRZ,
+              BRGT0:  self.opcode_BRGT0,
+              BRLT0:  self.opcode_BRLT0,
+              BRNULL: self.opcode_BRNULL,
+
+              EQ:     self.opcode_EQ,
+              LT:     self.opcode_LT,
+              LE:     self.opcode_LE,
+              GT:     self.opcode_GT,
+              GE:     self.opcode_GE,
+              MOD:    self.opcode_MOD,
+
+              AP1:    self.opcode_AP1,
+              AP2:    self.opcode_AP2,
+              APN:    self.opcode_APN,
+
              }[op_code]
 
-        op()
+        if not self.source or c not in self.source: # no source map: the common case
+            op()
+            return
+
+        try:
+            op()
+        except AssertionError, e:
+            function, source = self.source[c]
+            where = 'in %s, at %s' % (function, source) if function is not None else 'at %s' % (source,)
+            message = '%s (%s)' % (e, where) if str(e) else where
+            raise AssertionError, message, sys.exc_info()[2]
 
 def draw_sample_graphs():
     """
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+
+"""
+Incremental sessions. A Session keeps one SECD machine whose
+environment holds a global frame of top-level definitions. Each
+definition is compiled once and its value stays in the machine, so
+evaluating an expression compiles just that expression, and changing
+a definition recompiles just that definition.
+"""
+
+from compiler import *
+
+# Sessions are long lived, so give them more memory than SECD() does.
+SESSION_MAX_ADDRESS = 100000
+
+class Session:
+    """
+    A read-eval loop over a persistent SECD machine.
+
+    >>> session = Session()
+    >>> session.define('double', [LAMBDA, ['x'], [ADD, 'x', 'x']])
+    >>> session.define('four', ['double', 2])
+    >>> session.evaluate(['double', 'four'])
+    8
+
+    Definitions may refer to each other, and to themselves, in any
+    order:
+
+    >>> session.define('even', [LAMBDA, ['n'], [IF, [ZEROP, 'n'], 1, ['odd', [SUB, 'n', 1]]]])
+    >>> session.define('odd', [LAMBDA, ['n'], [IF, [ZEROP, 'n'], 0, ['even', [SUB, 'n', 1]]]])
+    >>> session.evaluate(['even', 10])
+    1
+
+    Redefining 'double' recompiles only 'double'. The value of 'four'
+    was computed with it, so its code runs again; 'even' and 'odd'
+    are untouched:
+
+    >>> session.compilations
+    6
+    >>> session.define('double', [LAMBDA, ['x'], [MUL, 'x', 3]])
+    >>> session.compilations
+    7
+    >>> session.evaluate('four')
+    6
+
+    Evaluating an expression never adds a slot to the global frame,
+    so a mistyped name is an error rather than a new global:
+
+    >>> session.evaluate(['dubble', 'four'])
+    Traceback (most recent call last):
+    ...
+    AssertionError: undefined: dubble
+    >>> 'dubble' in session.slots
+    False
+    """
+
+    def __init__(self, max_address=SESSION_MAX_ADDRESS):
+        self.machine = SECD(max_address)
+        self.machine.halt_stream = None
+
+        self.names   = [] # names of the global slots, in order
+        self.slots   = {} # name -> address of its cell in the global frame
+        self.source  = {} # name -> expression it is defined as
+        self.code    = {} # name -> compiled code of the definition
+        self.depends = {} # name -> names of the globals its definition uses
+
+        self.compilations = 0
+
+        # The global environment holds a single frame, which starts empty
+        # and ends in this nil cell.
+        m = self.machine
+        self.frame_end = m.get_new_address()
+        m.set_nonterminal(self.frame_end, 0, 0)
+        self.env = m.get_new_address()
+        m.set_nonterminal(self.env, self.frame_end, 0)
+
+    def slot(self, name):
+        """
+        The cell of the global frame holding 'name', added at the end of
+        the frame if it is new. Existing slots never move, so code that
+        was compiled earlier still finds them with the same LD [i, j].
+        """
+
+        if name not in self.slots:
+            m = self.machine
+            cell = self.frame_end
+            self.frame_end = m.get_new_address()
+            m.set_nonterminal(self.frame_end, 0, 0)
+            m.set_nonterminal(cell, 0, self.frame_end) # the value is nil until defined
+
+            self.slots[name] = cell
+            self.names.append(name)
+        return self.slots[name]
+
+    def compile(self, e):
+        """
+        Compile 'e' in the global scope, in which its free variables
+        must already have a slot.
+        """
+
+        self.compilations += 1
+        return compile(e, [self.names], [STOP])
+
+    def run(self, code):
+        """
+        Run 'code' in the global environment and return the address of
+        its result.
+        """
+
+        m = self.machine
+        m.load_program(code)
+        m.registers['E'] = self.env
+        m.join_stack = []
+        while m.running:
+            m.execute_opcode()
+        return m.car(m.registers['S'])
+
+    def define(self, name, e):
+        """
+        Set the global 'name' to the value of 'e'. Nothing is done if
+        'name' already has this definition. Otherwise every definition
+        that uses 'name', directly or indirectly, is brought up to date
+        by running its code again; definitions of functions are skipped,
+        since a function looks up the globals it uses when it is called.
+        """
+
+        if self.source.get(name) == e:
+            return
+
+        # The globals that 'e' uses get a slot now, so that a definition
+        # can use a global defined later.
+        cell = self.slot(name)
+        for other in sorted(free_variables(e)):
+            self.slot(other)
+
+        self.source[name]  = e
+        self.code[name]    = self.compile(e)
+        self.depends[name] = free_variables(e)
+
+        m = self.machine
+        m.set_nonterminal(cell, self.run(self.code[name]), m.cdr(cell))
+
+        for other in self.dependents(name):
+            if not (type(self.source[other]) == list and self.source[other][0] == LAMBDA):
+                cell = self.slots[other]
+                m.set_nonterminal(cell, self.run(self.code[other]), m.cdr(cell))
+
+    def dependents(self, name):
+        """
+        The definitions that use 'name', directly or indirectly, in an
+        order where each one comes after the definitions it uses. A
+        global's slot may be made early by a reference from a function,
+        so slot order is not enough:
+
+        >>> session = Session()
+        >>> session.define('q', [LAMBDA, [], 'w'])
+        >>> session.define('r', [LAMBDA, [], 'y'])
+        >>> session.define('x', 1)
+        >>> session.define('y', [ADD, 'x', 1])
+        >>> session.define('w', [ADD, 'y', 1])
+        >>> session.dependents('x')
+        ['y', 'w', 'q', 'r']
+        >>> session.define('x', 10)
+        >>> session.evaluate('w')
+        12
+        """
+
+        found = set()
+        work  = [name]
+        while work:
+            x = work.pop()
+            for other in self.source:
+                if other not in found and other != name and x in self.depends[other]:
+                    found.add(other)
+                    work.append(other)
+
+        ordered = []
+        visited = set()
+
+        def visit(x):
+            if x in visited:
+                return
+            visited.add(x)
+            for y in sorted(self.depends[x], key=self.names.index):
+                if y in found:
+                    visit(y)
+            ordered.append(x)
+
+        for other in self.names:
+            if other in found:
+                visit(other)
+
+        return ordered
+
+    def evaluate(self, e):
+        """
+        The value of the expression 'e', as a Python object. Every
+        global that 'e' uses must have been defined, or at least used
+        by a definition.
+        """
+
+        undefined = sorted(free_variables(e).difference(self.slots))
+        assert not undefined, 'undefined: %s' % ', '.join(undefined)
+
+        return self.machine.to_python(self.run(self.compile(e)))
+
+    def load(self, forms):
+        """
+        Evaluate a sequence of forms, such as reader.read_forms()
+        produces, where [DEFINE, name, e] defines a global. Returns the
+        value of the last form that is not a definition. Loading a file
+        again after editing it only recompiles the definitions that
+        changed.
+
+        >>> from reader import read_forms
+        >>> from StringIO import StringIO
+        >>> session = Session()
+        >>> source = '''
+        ...     (define sum (lambda (x) (if (null x) 0 (+ (car x) (sum (cdr x))))))
+        ...     (define xs (list 1 2 3))
+        ...     (sum xs)'''
+        >>> session.load(read_forms(StringIO(source)))
+        6
+        >>> session.load(read_forms(StringIO(source.replace('2', '20'))))
+        24
+        >>> session.compilations
+        5
+        """
+
+        value = None
+        for form in forms:
+            if type(form) == list and form and form[0] == DEFINE:
+                assert len(form) == 3, 'expected (define name expression): %s' % form
+                self.define(form[1], form[2])
+            else:
+                value = self.evaluate(form)
+        return value